@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Wrapper to benchmark the approximate denoise methods against the exact
+bilateral filter on the sample images
+"""
+from gfracture.fractureimage import FractureImage
+import pandas as pd
+
+filenames = ['./data/AC1_02.TIF', './data/pavement2.png']
+benchmarks = []
+
+for filename in filenames:
+    sample = FractureImage(filename)
+    sample.show_figures = False
+    sample.save_figures = False
+    sample.canny_edges = 'horizontal'
+    sample.canny_threshold = (0.2,0.4)
+    
+    for denoise_spatial_sd in [0.33, 1, 2, 4]:
+        sample.denoise_spatial_sd = denoise_spatial_sd
+        sample.benchmark_denoise(methods=('bilateral_grid', 'guided'))
+        benchmarks.append(sample.denoise_benchmark.assign(image=filename))
+
+pd.concat(benchmarks).to_csv('./output/denoise_benchmark.csv', index=False)
@@ -3,4 +3,8 @@ import gfracture.functions
 import gfracture.geostatsdataframe
 from gfracture.geostatsdataframe import GeostatsDataFrame
 import gfracture.variogram
-from gfracture.variogram import Variogram
\ No newline at end of file
+from gfracture.variogram import Variogram
+import gfracture.kriging
+from gfracture.kriging import OrdinaryKriging
+import gfracture.simulation
+from gfracture.simulation import SequentialGaussianSimulation
\ No newline at end of file
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy import ndimage as ndi
+from skimage import util
+
+def bilateral_grid(img, sigma_spatial=1, sigma_color=None, range_samples=2):
+    """
+    Bilateral filter approximated on a grid downsampled to cells of
+    about sigma_spatial pixels and range_samples intensity bins per 
+    sigma_color (Paris & Durand's bilateral grid). Pixels are splatted
+    into the grid with linear weights in intensity, the grid is Gaussian
+    blurred in space and intensity, and each pixel reads back the ratio
+    of blurred values to blurred weights by linear interpolation. The
+    cost grows with the grid rather than the filter window. sigma_color
+    defaults to the standard deviation of the image, as 
+    denoise_bilateral.
+    """
+    img = util.img_as_float(img)
+    if sigma_color is None:
+        sigma_color = img.std()
+    if sigma_color == 0:
+        return img.copy()
+    
+    n_rows, n_cols = img.shape
+    step = max(int(sigma_spatial), 1)
+    level_pos = (img - img.min()) * (range_samples / sigma_color)
+    level = level_pos.astype(np.intp)
+    frac = level_pos - level
+    grid_shape = (-(-n_rows // step), -(-n_cols // step), level.max() + 2)
+    cell = ((np.arange(n_rows) // step)[:,None] * grid_shape[1] 
+            + (np.arange(n_cols) // step)[None,:]) * grid_shape[2] + level
+    
+    size = np.prod(grid_shape)
+    grid = []
+    for values in [np.ones_like(img), img]:
+        splat = (np.bincount(cell.ravel(), (values * (1 - frac)).ravel(), size) 
+                 + np.bincount(cell.ravel() + 1, (values * frac).ravel(), size))
+        grid.append(ndi.gaussian_filter(
+            splat.reshape(grid_shape).astype(np.float32), 
+            (sigma_spatial / step, sigma_spatial / step, range_samples), 
+            mode='constant'
+            ))
+    weights, values = grid
+    
+    if step == 1:
+        weights, values = weights.ravel(), values.ravel()
+        return ((values[cell] * (1 - frac) + values[cell + 1] * frac)
+                / (weights[cell] * (1 - frac) + weights[cell + 1] * frac))
+    # cell centres are at (step - 1) / 2 in pixels
+    rows, cols = np.meshgrid((np.arange(n_rows) - (step - 1) / 2) / step,
+                             (np.arange(n_cols) - (step - 1) / 2) / step,
+                             indexing='ij')
+    coords = [rows, cols, level_pos]
+    return (ndi.map_coordinates(values, coords, order=1, mode='nearest')
+            / ndi.map_coordinates(weights, coords, order=1, mode='nearest'))
+
+def guided_filter(img, radius=1, eps=None):
+    """
+    Edge-preserving smoothing of an image guided by itself (He et al.):
+    a local linear model fitted in (2 * radius + 1) square windows
+    smooths where the local variance is below eps and keeps edges where
+    it is above. eps defaults to the variance of the image. Costs six
+    box filters whatever the radius.
+    """
+    img = util.img_as_float(img)
+    if eps is None:
+        eps = img.var()
+    size = 2 * radius + 1
+    mean = ndi.uniform_filter(img, size)
+    variance = ndi.uniform_filter(img * img, size) - mean**2
+    slope = variance / (variance + eps) if eps > 0 else np.ones_like(img)
+    intercept = mean - slope * mean
+    return ndi.uniform_filter(slope, size) * img + ndi.uniform_filter(intercept, size)
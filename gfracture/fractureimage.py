@@ -3,19 +3,189 @@ from skimage.restoration import denoise_bilateral
 from skimage.feature import canny
 from skimage.filters import sobel, sobel_h, sobel_v, apply_hysteresis_threshold
 from skimage.exposure import equalize_hist, rescale_intensity, cumulative_distribution
-from skimage.morphology import binary_closing, square
+from skimage.morphology import binary_closing, square, skeletonize
 from skimage.transform import probabilistic_hough_line
 from skimage.segmentation import clear_border
+from scipy import ndimage as ndi
 from shapely.geometry import LineString
+from gfracture.tiling import (tile_slices, stage_array, imap_tiles, map_tiles, 
+                              tile_min_max, tile_std, label_tiles, relabel_tiles,
+                              clip_segments, merge_seam_segments)
+from gfracture.imagesource import TiffSource
+from gfracture.denoise import bilateral_grid, guided_filter
+from gfracture.vectorize import component_lines, skeleton_polylines
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from contextlib import nullcontext
+from functools import partial
 import matplotlib.pyplot as plt
 import geopandas as gpd
 import numpy as np
+import pandas as pd
+import hashlib
+import itertools
+import json
+import os
+import time
+
+def hough_summary(packed_edges, shape, line_length, line_gap, threshold):
+    """Line count and total length of the probabilistic Hough lines of a 
+    bit-packed edge image"""
+    edges = np.unpackbits(
+        packed_edges, count=shape[0] * shape[1]
+        ).reshape(shape).astype(bool)
+    lines = probabilistic_hough_line(
+        edges, line_length=line_length, line_gap=line_gap, threshold=threshold
+        )
+    lengths = [np.hypot(x1 - x0, y1 - y0) for (x0, y0), (x1, y1) in lines]
+    return len(lines), float(np.sum(lengths))
+
+def stage_key(*parts):
+    """Hex digest of the JSON of a stage's upstream key and parameters"""
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+def edge_magnitude(img, canny_edges=None):
+    """One-way Sobel edge magnitude in the canny_edges direction"""
+    if canny_edges =='horizontal':
+        return sobel_h(img).clip(min=0)
+    elif canny_edges == 'vertical':
+        return sobel_v(img).clip(min=0)
+    else:
+        return sobel(img).clip(min=0)
+
+def sobel_components(img):
+    """Horizontal and vertical Sobel components"""
+    return sobel_h(img), sobel_v(img)
+
+def directional_magnitudes(img, directions=('horizontal', 'vertical')):
+    """One-way horizontal and vertical and combined Sobel magnitudes from
+    a single computation of the gradient components"""
+    horizontal, vertical = sobel_components(img)
+    magnitudes = {}
+    for direction in directions:
+        if direction == 'horizontal':
+            magnitudes[direction] = horizontal.clip(min=0)
+        elif direction == 'vertical':
+            magnitudes[direction] = vertical.clip(min=0)
+        else:
+            magnitudes[direction] = np.sqrt((horizontal**2 + vertical**2) / 2)
+    return magnitudes
+
+def hysteresis_masks(img, low, high, canny_edges=None):
+    """Low and high threshold masks of the edge magnitude"""
+    magnitude = edge_magnitude(img, canny_edges)
+    return magnitude > low, magnitude > high
+
+def fused_edge_mask(img, low, high, canny_edges=None, block_rows=512):
+    """
+    Hysteresis edges of the one-way Sobel magnitude in the canny_edges
+    direction, fused block by block: each block of rows (with a one row
+    halo) is converted to float32, smoothed, differenced, clipped and
+    thresholded in preallocated buffers. Only a uint8 low/high state,
+    the int32 labels of the low mask and the returned edge mask are the
+    size of the image.
+    """
+    n_rows, n_cols = img.shape
+    low = min(low, high)
+    state = np.empty((n_rows, n_cols), dtype=np.uint8)
+    padded = np.empty((block_rows + 2, n_cols + 2), dtype=np.float32)
+    smooth = np.empty((block_rows + 2, n_cols), dtype=np.float32)
+    magnitude = np.empty((block_rows, n_cols), dtype=np.float32)
+    vertical = np.empty((block_rows, n_cols), dtype=np.float32)
+    above = np.empty((block_rows, n_cols), dtype=bool)
+    
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        n = stop - start
+        # symmetric one pixel border, as ndimage's 'reflect' mode
+        top, bottom = max(start - 1, 0), min(stop + 1, n_rows)
+        offset = 1 - (start - top)
+        padded[offset:offset + bottom - top, 1:-1] = util.img_as_float32(
+            np.asarray(img[top:bottom, :])
+            )
+        if offset:
+            padded[0, 1:-1] = padded[1, 1:-1]
+        if bottom == stop:
+            padded[n + 1, 1:-1] = padded[n, 1:-1]
+        padded[:n + 2, 0] = padded[:n + 2, 1]
+        padded[:n + 2, -1] = padded[:n + 2, -2]
+        block = padded[:n + 2]
+        mag, vert, mask, sm = magnitude[:n], vertical[:n], above[:n], smooth[:n + 2]
+        
+        if canny_edges != 'vertical':
+            # rows of [1, 2, 1] / 4 smoothing along columns, differenced
+            np.add(block[:,:-2], block[:,2:], out=sm)
+            np.add(sm, block[:,1:-1], out=sm)
+            np.add(sm, block[:,1:-1], out=sm)
+            np.subtract(sm[2:], sm[:-2], out=mag)
+            mag *= 0.25
+        if canny_edges != 'horizontal':
+            out = vert if canny_edges is None else mag
+            np.subtract(block[:,2:], block[:,:-2], out=sm)
+            np.add(sm[:-2], sm[2:], out=out)
+            np.add(out, sm[1:-1], out=out)
+            np.add(out, sm[1:-1], out=out)
+            out *= 0.25
+        if canny_edges is None:
+            np.multiply(mag, mag, out=mag)
+            np.multiply(vert, vert, out=vert)
+            np.add(mag, vert, out=mag)
+            mag *= 0.5
+            np.sqrt(mag, out=mag)
+        else:
+            np.maximum(mag, 0, out=mag)
+        
+        np.greater(mag, low, out=mask)
+        state[start:stop] = mask
+        np.greater(mag, high, out=mask)
+        state[start:stop] += mask
+    del padded, smooth, magnitude, vertical, above
+    
+    labels = np.empty((n_rows, n_cols), dtype=np.int32)
+    n_labels = ndi.label(state, output=labels)
+    connected_to_high = np.zeros(n_labels + 1, dtype=bool)
+    for start in range(0, n_rows, block_rows):
+        rows = slice(start, start + block_rows)
+        connected_to_high[labels[rows][state[rows] == 2]] = True
+    connected_to_high[0] = False
+    del state
+    
+    edges = np.empty((n_rows, n_cols), dtype=bool)
+    for start in range(0, n_rows, block_rows):
+        rows = slice(start, start + block_rows)
+        np.take(connected_to_high, labels[rows], out=edges[rows])
+    return edges
+
+def float_bilateral(img, **kwargs):
+    """denoise_bilateral of util.img_as_float(img), whose colour lookup
+    table does not depend on the raw integer range of the image or tile"""
+    return denoise_bilateral(util.img_as_float(img), channel_axis=None, **kwargs)
+
+def close_gaps(edges, gap_fill_px):
+    """Binary closing with a square of gap_fill_px"""
+    return binary_closing(edges, square(gap_fill_px))
+
+def skeleton_tile(tile):
+    """Skeleton of the labelled pixels of a tile"""
+    return skeletonize(tile > 0)
+
+def hough_tile(tile, inner, line_length, line_gap, threshold):
+    """Probabilistic Hough segments of a padded tile clipped to the core 
+    of the tile, in core pixel coordinates"""
+    lines = probabilistic_hough_line(
+        tile, line_length=line_length, line_gap=line_gap, threshold=threshold
+        )
+    segments = (np.array(lines, dtype=float).reshape(-1, 2, 2)
+                - [inner[1].start, inner[0].start])
+    n_rows, n_cols = inner[0].stop - inner[0].start, inner[1].stop - inner[1].start
+    return clip_segments(segments, (-0.5, n_cols - 0.5, -0.5, n_rows - 0.5))
 
 class FractureImage(object):
     """A class to contain the results of fracture segmentation on 
     a core or outcrop image"""
     
     denoise_spatial_sd = 0.33
+    denoise_method = 'bilateral'
     canny_edges = None
     canny_threshold = (0,1)
     gap_fill_px = 3
@@ -23,12 +193,47 @@ class FractureImage(object):
     phough_min_line_length_px = 50
     phough_line_gap_px = 10
     phough_accumulator_threshold = 100
+    vectorize_method = 'phough'
+    line_fit_tolerance_px = 3.0
+    polyline_tolerance_px = 1.0
     show_figures = True
     save_figures = True
+    tile_px = None
+    tile_dir = './output/tiles/'
+    n_jobs = 1
+    stage_cache = False
+    cache_dir = './output/stage_cache/'
+    cache_compress = False
+    cache_max_gb = 10
+    fused_edges = False
+    edge_block_rows = 512
     
-    def __init__(self, filepath):
-        self.img_orig = io.imread(filepath, as_gray = True)
-        self.img = self.img_orig.copy()
+    def __init__(self, filepath, roi = None, level = 0, lazy = False):
+        """
+        Load an image as grayscale. For TIFFs, roi = (row_min, row_max,
+        col_min, col_max) reads only that bounding box and level picks a
+        pyramid level. lazy keeps the TIFF as a TiffSource that tiled 
+        stages read (and convert to grayscale) one tile at a time, so it
+        needs tile_px (or fused_edges for detect_edges); untiled stages
+        raise a ValueError rather than read the whole image.
+        """
+        if roi is None and level == 0 and not lazy:
+            self.img_orig = io.imread(filepath, as_gray = True)
+        elif Path(filepath).suffix.lower() in ('.tif', '.tiff'):
+            self.img_orig = TiffSource(filepath, roi, level)
+            if not lazy:
+                self.img_orig = self.img_orig[:,:]
+        else:
+            self.img_orig = io.imread(filepath, as_gray = True)
+            if roi is not None:
+                self.img_orig = self.img_orig[roi[0]:roi[1], roi[2]:roi[3]]
+        # every stage assigns a new image, so the original is not copied
+        self.img = self.img_orig
+        file_stat = Path(filepath).stat()
+        self.img_key = stage_key(
+            str(Path(filepath).resolve()), file_stat.st_size, 
+            file_stat.st_mtime_ns, roi, level
+            )
     
     def list_params(self):
         """ Print a list of object parameters """
@@ -42,6 +247,73 @@ class FractureImage(object):
         print('phough_min_line_length_px: ' + str(self.phough_min_line_length_px))
         print('phough_line_gap_px: ' + str(self.phough_line_gap_px))
         print('phough_accumulator_threshold: ' + str(self.phough_accumulator_threshold))
+        print('tile_px: ' + str(self.tile_px))
+        print('n_jobs: ' + str(self.n_jobs))
+        print('stage_cache: ' + str(self.stage_cache))
+        
+    def tile_array(self, name, dtype):
+        """Full size output of a tiled stage, memory-mapped in tile_dir so
+        that only tiles are held in memory (in memory if tile_dir is None)"""
+        return stage_array(self.img.shape, dtype, self.tile_dir, name)
+        
+    def cached_stage(self, name, params, upstream_key, compute):
+        """
+        Output and key of a stage, where the key hashes the key of the 
+        stage input and the stage parameters. With stage_cache set, outputs
+        are saved under cache_dir (memory-mapped .npy, or .npz if 
+        cache_compress) and loaded instead of computed when the key 
+        matches. Memory-mapped hits are copy-on-write, so later stages
+        may write to them without touching the cache.
+        """
+        key = stage_key(upstream_key, name, params)
+        if not self.stage_cache:
+            return compute(), key
+        
+        path = Path(self.cache_dir) / (
+            name + '_' + key + ('.npz' if self.cache_compress else '.npy')
+            )
+        if path.exists():
+            print('Loading cached ' + name)
+            os.utime(path)
+            if self.cache_compress:
+                return np.load(path)['stage'], key
+            return np.load(path, mmap_mode='c'), key
+        
+        out = compute()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self.cache_compress:
+            np.savez_compressed(path, stage=out)
+        else:
+            np.save(path, out)
+        self.evict_cache(path)
+        return out, key
+    
+    def evict_cache(self, keep):
+        """Delete the least recently used cached stages until the cache is
+        under cache_max_gb"""
+        files = sorted(Path(self.cache_dir).glob('*.np[yz]'), 
+                       key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        for f in files:
+            if total <= self.cache_max_gb * 2**30:
+                break
+            if f != keep:
+                total -= f.stat().st_size
+                f.unlink()
+    
+    def require_in_memory(self, stage, remedy='set tile_px or load it with lazy=False'):
+        """Raise for an untiled stage on a lazy image, which would 
+        otherwise read the whole image into memory"""
+        if isinstance(self.img, TiffSource):
+            raise ValueError(
+                stage + ' would read the whole lazy image: ' + remedy
+                )
+    
+    def tile_pool(self):
+        """Process pool for tiled stages when n_jobs > 1"""
+        if self.n_jobs > 1:
+            return ProcessPoolExecutor(self.n_jobs)
+        return nullcontext()
         
     def show_img(self):
         """ Show image using io.imshow and matplotlib """
@@ -49,15 +321,20 @@ class FractureImage(object):
         plt.show(block=False)
 
     def equalize_img_hist(self, method = 'equalize'):
-        """ Equalize or rescale image histogram """
+        """ Equalize or rescale image histogram. There is no tiled 
+        version, so lazy images must be loaded with lazy=False. """
+        self.require_in_memory('equalize_img_hist', 'load it with lazy=False')
         if method == 'rescale':
             print('Rescaling image histogram')
-            self.img = rescale_intensity(
+            compute = lambda: rescale_intensity(
                 self.img, in_range=np.percentile(self.img, (2, 98))
                 )
         else:
             print('Equalizing image histogram')
-            self.img = equalize_hist(self.img)
+            compute = lambda: equalize_hist(self.img)
+        self.img, self.img_key = self.cached_stage(
+            'equalized', {'method': method}, self.img_key, compute
+            )
 
         if self.show_figures:
             self.plot_img_hist()
@@ -78,40 +355,145 @@ class FractureImage(object):
         plt.show()
 
     def denoise(self):
-        """ Run a bilateral denoise on the raw image """
+        """ Run a bilateral denoise on the raw image, exact or with the 
+        approximation set by denoise_method (bilateral_grid or guided) """
         print('Denoising Image')
 
         if self.denoise_spatial_sd <= 0.15:
             print('setting denoise_spatial_sd to 0.15 (minimum value')
             self.denoise_spatial_sd = 0.15
         
-        self.img = denoise_bilateral(
-                self.img, sigma_spatial = self.denoise_spatial_sd, 
-                multichannel=False)
+        params = {'denoise_spatial_sd': self.denoise_spatial_sd}
+        if self.denoise_method != 'bilateral':
+            params['denoise_method'] = self.denoise_method
+        if self.tile_px is not None:
+            # tiles only approximate the whole-image filter
+            params['tile_px'] = self.tile_px
+        self.img, self.img_key = self.cached_stage(
+            'denoised', params, self.img_key, self.denoised
+            )
         
         if self.show_figures:
             io.imshow(self.img)
             plt.show(block=False)
 
+    def denoised(self):
+        if self.tile_px is not None:
+            return self.tiled_denoise()
+        
+        self.require_in_memory('denoise')
+        return self.denoise_filter()[0](np.asarray(self.img))
+    
+    def denoise_filter(self, sigma_color=None):
+        """
+        The denoise function of denoise_method and the halo it needs in
+        tiled mode. bilateral_grid approximates the bilateral filter on a
+        grid of about denoise_spatial_sd pixels, and guided smooths with
+        windows of twice denoise_spatial_sd and a regularization of
+        sigma_color squared. sigma_color defaults to the standard 
+        deviation of the image.
+        """
+        sd = self.denoise_spatial_sd
+        if self.denoise_method == 'bilateral_grid':
+            step = max(int(sd), 1)
+            return (partial(bilateral_grid, sigma_spatial = sd, 
+                            sigma_color = sigma_color),
+                    (int(4 * sd / step + 0.5) + 2) * step)
+        elif self.denoise_method == 'guided':
+            radius = max(1, int(round(2 * sd)))
+            eps = None if sigma_color is None else sigma_color**2
+            return partial(guided_filter, radius = radius, eps = eps), 2 * radius
+        else:
+            win_size = max(5, 2 * int(np.ceil(3 * sd)) + 1)
+            return (partial(float_bilateral, sigma_color = sigma_color, 
+                            win_size = win_size, sigma_spatial = sd),
+                    win_size // 2)
+    
+    def benchmark_denoise(self, methods=('bilateral_grid', 'guided')):
+        """
+        Runtime of each denoise_method against the exact bilateral 
+        filter, with the RMS difference of the denoised images and the 
+        agreement of the edge maps at the current canny_edges and 
+        canny_threshold. Sets denoise_benchmark; the image is unchanged.
+        """
+        saved = self.denoise_method
+        rows = []
+        for method in ['bilateral'] + [m for m in methods if m != 'bilateral']:
+            self.denoise_method = method
+            start = time.perf_counter()
+            denoised = np.asarray(self.denoised())
+            runtime = time.perf_counter() - start
+            img_range = denoised.max() - denoised.min()
+            edges = apply_hysteresis_threshold(
+                edge_magnitude(denoised, self.canny_edges), 
+                self.canny_threshold[0]*img_range, self.canny_threshold[1]*img_range
+                )
+            if method == 'bilateral':
+                exact, exact_edges, exact_runtime = denoised, edges, runtime
+            rows.append({
+                'denoise_method': method,
+                'denoise_spatial_sd': self.denoise_spatial_sd,
+                'runtime_s': runtime, 
+                'speedup': exact_runtime / runtime,
+                'rmse': np.sqrt(np.mean((denoised - exact)**2)),
+                'edge_agreement_pct': np.mean(edges == exact_edges) * 100,
+                'edge_dice': 2 * np.sum(edges & exact_edges) 
+                    / max(edges.sum() + exact_edges.sum(), 1)
+                })
+        self.denoise_method = saved
+        self.denoise_benchmark = pd.DataFrame(rows)
+        print(self.denoise_benchmark.to_string(index=False))
+    
+    def write_denoise_benchmark(self, filename=None):
+        """ Save the denoise benchmark as csv """
+        if filename is None:
+            filename='./output/denoise_benchmark'
+        self.denoise_benchmark.to_csv(filename+'.csv', index=False)
+
     def detect_edges(self, filename=None):
-        """Edge filter an image using the Canny algorithm."""
+        """Edge filter an image using the Canny algorithm. With fused_edges
+        the magnitude and thresholds are computed in float32 blocks of 
+        edge_block_rows, see fused_edge_mask."""
         if filename is None:
             filename='./output/phough_transform'
 
-        low = self.canny_threshold[0]*(self.img.max()-self.img.min())
-        high = self.canny_threshold[1]*(self.img.max()-self.img.min())
+        if self.tile_px is None and not self.fused_edges:
+            self.require_in_memory('detect_edges')
+            img_min, img_max = self.img.min(), self.img.max()
+        else:
+            # one blockwise pass for both, which also reads lazy images
+            img_min, img_max = tile_min_max(
+                self.img, self.tile_px or self.edge_block_rows
+                )
+        low = self.canny_threshold[0]*(img_max-img_min)
+        high = self.canny_threshold[1]*(img_max-img_min)
 
         if self.canny_edges =='horizontal':
             print('Running One-Way Horizontal Edge Detector')
-            magnitude = sobel_h(self.img).clip(min=0)
         elif self.canny_edges == 'vertical':
             print('Running One-Way Vertical Edge Detector')
-            magnitude = sobel_v(self.img).clip(min=0)
         else:
             print('Running One-Way Multidirectional Edge Detector')
-            magnitude = sobel(self.img).clip(min=0)
         
-        self.edges = apply_hysteresis_threshold(magnitude,low,high)
+        params = {'canny_edges': self.canny_edges, 'low': low, 'high': high}
+        if self.tile_px is not None:
+            compute = lambda: self.tiled_hysteresis(low, high)
+        elif self.fused_edges:
+            # float32 magnitudes can round across a threshold, so fused
+            # edges are cached apart from the float64 ones
+            params['dtype'] = 'float32'
+            compute = lambda: fused_edge_mask(
+                self.img, low, high, self.canny_edges, self.edge_block_rows
+                )
+        else:
+            magnitude, _ = self.cached_stage(
+                'sobel_magnitude', {'canny_edges': self.canny_edges}, 
+                self.img_key, lambda: self.edge_magnitude(self.img)
+                )
+            compute = lambda: apply_hysteresis_threshold(magnitude,low,high)
+        self.edges, self.edges_key = self.cached_stage(
+            'edges', params, self.img_key, compute
+            )
 
         if self.show_figures:
             io.imshow(self.edges)
@@ -120,6 +502,76 @@ class FractureImage(object):
         if self.save_figures:
             io.imsave(filename+'.tif',util.img_as_ubyte(self.edges))
     
+    def detect_directional_edges(self, directions=('horizontal', 'vertical'),
+                                 filename=None):
+        """
+        Edge maps for several canny_edges directions (horizontal, vertical
+        or None for multidirectional) in one call: the Sobel components are
+        computed once, every magnitude is derived from them, and all the 
+        low masks are labelled in one pass for the hysteresis thresholds.
+        Sets directional_edges; select_edges(direction) makes one of them 
+        the edges for closing, labelling and the Hough transform. Tiled 
+        mode thresholds each direction in turn.
+        """
+        if filename is None:
+            filename='./output/phough_transform'
+        print('Running One-Way Directional Edge Detectors: ' 
+              + ', '.join(map(str, directions)))
+        
+        if self.tile_px is None:
+            self.require_in_memory('detect_directional_edges')
+            img_min, img_max = self.img.min(), self.img.max()
+        else:
+            img_min, img_max = tile_min_max(self.img, self.tile_px)
+        low = min(self.canny_threshold[0], self.canny_threshold[1])*(img_max-img_min)
+        high = self.canny_threshold[1]*(img_max-img_min)
+        
+        def compute():
+            if self.tile_px is not None:
+                canny_edges = self.canny_edges
+                edges = []
+                for direction in directions:
+                    self.canny_edges = direction
+                    edges.append(np.asarray(self.tiled_hysteresis(low, high)))
+                self.canny_edges = canny_edges
+                return np.stack(edges)
+            
+            magnitudes = np.stack(list(
+                directional_magnitudes(self.img, directions).values()
+                ))
+            # label each direction's plane on its own in a single pass
+            structure = np.zeros((3, 3, 3), dtype=bool)
+            structure[1] = ndi.generate_binary_structure(2, 1)
+            labels, n_labels = ndi.label(magnitudes > low, structure)
+            connected_to_high = np.bincount(
+                labels[magnitudes > high], minlength=n_labels + 1
+                ) > 0
+            connected_to_high[0] = False
+            return connected_to_high[labels]
+        
+        edges, edges_key = self.cached_stage(
+            'directional_edges', 
+            {'directions': directions, 'low': low, 'high': high},
+            self.img_key, compute
+            )
+        self.directional_edges = dict(zip(directions, edges))
+        self.directional_edges_key = edges_key
+        
+        if self.save_figures:
+            for direction, direction_edges in self.directional_edges.items():
+                io.imsave(filename + '_' + str(direction) + '.tif',
+                          util.img_as_ubyte(direction_edges))
+    
+    def select_edges(self, direction):
+        """Use one of the directional_edges as the edges"""
+        self.canny_edges = direction
+        self.edges = self.directional_edges[direction]
+        self.edges_key = stage_key(self.directional_edges_key, direction)
+    
+    def edge_magnitude(self, img):
+        """One-way Sobel edge magnitude in the canny_edges direction"""
+        return edge_magnitude(img, self.canny_edges)
+    
     def sigma_to_mean_threshold(self, sigma):
         mean = np.mean(self.img)
         print(f"Mean: {mean:.3f}")
@@ -140,7 +592,10 @@ class FractureImage(object):
         """ Close small holes with binary closing to within x pixels """
         print('Closing binary edge gaps')
         
-        self.edges = binary_closing(self.edges, square(self.gap_fill_px))
+        self.edges, self.edges_key = self.cached_stage(
+            'closed_edges', {'gap_fill_px': self.gap_fill_px}, 
+            self.edges_key, self.closed_edges
+            )
         
         if self.show_figures:
             io.imshow(self.edges)
@@ -149,24 +604,58 @@ class FractureImage(object):
         if self.save_figures:
             io.imsave('./output/closededges.tif',util.img_as_ubyte(self.edges))
     
+    def closed_edges(self):
+        if self.tile_px is None:
+            return close_gaps(self.edges, self.gap_fill_px)
+        with self.tile_pool() as pool:
+            return map_tiles(
+                partial(close_gaps, gap_fill_px=self.gap_fill_px),
+                self.edges, self.tile_array('closed_edges', bool), 
+                self.tile_px, self.gap_fill_px, pool, self.n_jobs
+                )
+    
     def label_edges(self):
         """ Label connected edges/components using skimage wrapper """
         print('Labelling connected edges')
         
-        self.edge_labels = measure.label(
-            self.edges, connectivity=2, background=0
+        self.edge_labels, self.labels_key = self.cached_stage(
+            'edge_labels', {}, self.edges_key, self.labelled_edges
             )
+        if self.tile_px is None:
+            self.n_edge_labels = len(np.unique(self.edge_labels))-1
+        else:
+            self.n_edge_labels = int(tile_min_max(self.edge_labels, self.tile_px)[1])
         
-        print(str(len(np.unique(self.edge_labels))-1) + ' components identified')
+        print(str(self.n_edge_labels) + ' components identified')
         self.count_edges()
 
         if self.show_figures:
             io.imshow(self.edge_labels)
             plt.show(block=False)
         
+    def labelled_edges(self):
+        if self.tile_px is None:
+            return measure.label(self.edges, connectivity=2, background=0)
+        labels = self.tile_array('edge_labels', np.int32)
+        with self.tile_pool() as pool:
+            label_map, _ = label_tiles(
+                np.asarray, self.edges, self.tile_px, labels, 
+                connectivity=2, pool=pool, n_jobs=self.n_jobs
+                )
+        return relabel_tiles(labels, label_map, self.tile_px)
+        
     def count_edges(self):
         """ Get a unique count of edges, omitting zero values  """       
-        unique, counts = np.unique(self.edge_labels, return_counts=True)
+        if self.tile_px is None:
+            unique, counts = np.unique(self.edge_labels, return_counts=True)
+        else:
+            counts = np.zeros(self.n_edge_labels + 1, dtype=np.int64)
+            for core, _, _ in tile_slices(self.edge_labels.shape, self.tile_px):
+                counts += np.bincount(
+                    np.asarray(self.edge_labels[core]).ravel(), 
+                    minlength=len(counts)
+                    )
+            unique = np.arange(len(counts))
         self.edge_dict = dict(zip(unique, counts))
         self.edge_dict.pop(0)
         
@@ -174,23 +663,165 @@ class FractureImage(object):
         
         print(str(edge_cov) + '% edge coverage')
             
+    def tiled_denoise(self):
+        """Bilateral denoise tile by tile with a halo of the filter window. 
+        The colour sigma is the standard deviation of the whole image, so
+        tiles differ from a whole image filter only through the binning of
+        the colour lookup table (or, for bilateral_grid, of the grid)."""
+        denoise_tile, halo = self.denoise_filter(tile_std(self.img, self.tile_px))
+        with self.tile_pool() as pool:
+            return map_tiles(
+                denoise_tile, self.img, self.tile_array('denoised', float), 
+                self.tile_px, halo, pool, self.n_jobs
+                )
+    
+    def tiled_hysteresis(self, low, high):
+        """Hysteresis threshold of the edge magnitude, with the low mask of
+        each tile (plus a one pixel halo for the Sobel kernel) labelled on
+        its own and merged across tile seams"""
+        labels = self.tile_array('hysteresis_labels', np.int32)
+        with self.tile_pool() as pool:
+            label_map, label_flag = label_tiles(
+                partial(hysteresis_masks, low=min(low, high), high=high, 
+                        canny_edges=self.canny_edges),
+                self.img, self.tile_px, labels, connectivity=1, halo=1, 
+                pool=pool, n_jobs=self.n_jobs
+                )
+        return relabel_tiles(
+            labels, label_flag[label_map], self.tile_px, 
+            out=self.tile_array('edges', bool)
+            )
+    
+    def tiled_phough_transform(self):
+        """Probabilistic Hough transform of tiles with a halo of the minimum
+        line length. Segments are clipped to tile interiors, and segments 
+        cut by tile seams are merged back together."""
+        worker = partial(
+            hough_tile, line_length=self.phough_min_line_length_px,
+            line_gap=self.phough_line_gap_px, 
+            threshold=self.phough_accumulator_threshold
+            )
+        segments = [np.zeros((0, 2, 2))]
+        with self.tile_pool() as pool:
+            for core, tile_segments in imap_tiles(
+                    worker, self.edge_labels, self.tile_px, 
+                    self.phough_min_line_length_px, pool, self.n_jobs):
+                segments.append(
+                    tile_segments + [core[1].start, core[0].start]
+                    )
+        
+        n_rows, n_cols = self.edge_labels.shape
+        merged = merge_seam_segments(
+            np.concatenate(segments), 
+            np.arange(self.tile_px, n_cols, self.tile_px) - 0.5,
+            np.arange(self.tile_px, n_rows, self.tile_px) - 0.5,
+            tol_px = 2.0
+            )
+        return [tuple(map(tuple, line)) for line in np.rint(merged).astype(int)]
+        
+    def sweep(self, grid):
+        """ Run every combination of a grid (dict of lists) of 
+        denoise_spatial_sd, canny_edges, canny_threshold (or 
+        mean_threshold_sigma), gap_fill_px and phough_* parameters into 
+        sweep_summary """
+        names = ['denoise_spatial_sd', 'canny_edges', 'canny_threshold', 
+                 'gap_fill_px', 'phough_min_line_length_px', 
+                 'phough_line_gap_px', 'phough_accumulator_threshold']
+        saved = {name: getattr(self, name) for name in names + ['img']}
+        options = {name: list(grid.get(name, [saved[name]])) for name in names}
+        hough_grid = list(itertools.product(*[options[name] for name in names[4:]]))
+        
+        # walk the grid as a tree, so each stage output is computed once
+        # for all the combinations below it; missing parameters keep their
+        # current values and everything is restored afterwards
+        rows, results = [], []
+        with self.tile_pool() as pool:
+            for denoise_sd in options['denoise_spatial_sd']:
+                self.img = saved['img']
+                self.denoise_spatial_sd = max(denoise_sd, 0.15)
+                self.img = np.asarray(self.denoised())
+                img_range = self.img.max() - self.img.min()
+                if 'mean_threshold_sigma' in grid:
+                    thresholds = []
+                    for sigma in grid['mean_threshold_sigma']:
+                        self.sigma_to_mean_threshold(sigma)
+                        thresholds.append((sigma, self.canny_threshold))
+                else:
+                    thresholds = [(None, t) for t in options['canny_threshold']]
+                
+                for canny_edges in options['canny_edges']:
+                    magnitude = edge_magnitude(self.img, canny_edges)
+                    for sigma, threshold in thresholds:
+                        edges = apply_hysteresis_threshold(
+                            magnitude, threshold[0]*img_range, threshold[1]*img_range
+                            )
+                        for gap_fill_px in options['gap_fill_px']:
+                            closed = close_gaps(edges, gap_fill_px)
+                            branch = {
+                                'denoise_spatial_sd': denoise_sd,
+                                'canny_edges': canny_edges,
+                                'mean_threshold_sigma': sigma,
+                                'canny_threshold_low': threshold[0],
+                                'canny_threshold_high': threshold[1],
+                                'gap_fill_px': gap_fill_px,
+                                'n_components': measure.label(closed, connectivity=2).max(),
+                                'edge_coverage_pct': closed.mean() * 100
+                                }
+                            # Hough transforms of the leaves run in the pool
+                            packed = np.packbits(closed)
+                            for hough in hough_grid:
+                                rows.append(dict(branch, **dict(zip(names[4:], hough))))
+                                args = (packed, closed.shape) + hough
+                                results.append(
+                                    hough_summary(*args) if pool is None
+                                    else pool.submit(hough_summary, *args)
+                                    )
+            results = [r if pool is None else r.result() for r in results]
+        
+        for name, value in saved.items():
+            setattr(self, name, value)
+        self.sweep_summary = pd.DataFrame(rows)
+        self.sweep_summary['n_lines'] = [r[0] for r in results]
+        self.sweep_summary['total_length_px'] = [r[1] for r in results]
+        if 'mean_threshold_sigma' not in grid:
+            self.sweep_summary = self.sweep_summary.drop(columns='mean_threshold_sigma')
+        print(str(len(rows)) + ' parameter combinations swept')
+        
+    def write_sweep_summary(self, filename=None):
+        """ Save the parameter sweep summary as csv """
+        if filename is None:
+            filename='./output/parameter_sweep'
+        self.sweep_summary.to_csv(filename+'.csv', index=False)
+        
     def run_phough_transform(self, filename=None):
-        """ Run the Probabilistic Hough Transform """
-        print('Running Probabilistic Hough Transform')
+        """ Run the Probabilistic Hough Transform, or fit lines to the 
+        labelled components if vectorize_method is 'pca', or trace 
+        polylines along their skeleton if it is 'skeleton' """
         if filename is None:
             filename='./output/phough_transform'
         
-        self.lines = probabilistic_hough_line(
-                self.edge_labels,    
-                line_length=self.phough_min_line_length_px,
-                line_gap=self.phough_line_gap_px,
-                threshold = self.phough_accumulator_threshold)
+        if self.vectorize_method == 'pca':
+            print('Fitting Lines to Labelled Components')
+            self.lines = self.fitted_lines()
+        elif self.vectorize_method == 'skeleton':
+            print('Tracing Skeleton Polylines')
+            self.lines = self.skeleton_lines()
+        elif self.tile_px is None:
+            print('Running Probabilistic Hough Transform')
+            self.lines = probabilistic_hough_line(
+                    self.edge_labels,    
+                    line_length=self.phough_min_line_length_px,
+                    line_gap=self.phough_line_gap_px,
+                    threshold = self.phough_accumulator_threshold)
+        else:
+            print('Running Probabilistic Hough Transform')
+            self.lines = self.tiled_phough_transform()
         
         if self.show_figures | self.save_figures:
             fig, ax = plt.subplots(1, 1)
             for line in self.lines:
-                p0, p1 = line
-                ax.plot((p0[0], p1[0]), (p0[1], p1[1]))
+                x, y = zip(*line)
+                ax.plot(x, y)
             ax.set_xlim((0, self.edge_labels.shape[1]))
             ax.set_ylim((self.edge_labels.shape[0], 0))
             ax.set_aspect('equal')
@@ -200,6 +831,54 @@ class FractureImage(object):
             if self.show_figures:
                 plt.show(block=False)
             
+    def fitted_lines(self):
+        """Deterministic line segments fitted to each labelled component
+        by its principal axis, split where it curves or branches by more
+        than line_fit_tolerance_px, see component_lines. Segments shorter
+        than phough_min_line_length_px are dropped."""
+        rows, cols, labels = self.nonzero_pixels(self.edge_labels)
+        return component_lines(
+            rows, cols, labels, min_length=self.phough_min_line_length_px,
+            tolerance=self.line_fit_tolerance_px
+            )
+    
+    def skeleton_lines(self):
+        """Polylines traced along the skeleton of the labelled edges,
+        split at junctions and simplified to polyline_tolerance_px, see 
+        skeleton_polylines. Polylines shorter than 
+        phough_min_line_length_px are dropped. Tiles are skeletonized 
+        with a halo of the minimum line length."""
+        if self.tile_px is None:
+            skeleton = skeletonize(self.edge_labels > 0)
+        else:
+            with self.tile_pool() as pool:
+                skeleton = map_tiles(
+                    skeleton_tile, self.edge_labels, 
+                    self.tile_array('skeleton', bool), self.tile_px, 
+                    self.phough_min_line_length_px, pool, self.n_jobs
+                    )
+        rows, cols, _ = self.nonzero_pixels(skeleton)
+        return [tuple(line) for line in skeleton_polylines(
+            rows, cols, min_length=self.phough_min_line_length_px,
+            tolerance=self.polyline_tolerance_px
+            )]
+    
+    def nonzero_pixels(self, image):
+        """Rows, columns and values of the nonzero pixels of an image, 
+        read tile by tile in tiled mode"""
+        if self.tile_px is None:
+            rows, cols = np.nonzero(image)
+            return rows, cols, image[rows, cols]
+        pixels = [np.zeros((3, 0), dtype=np.int64)]
+        for core, _, _ in tile_slices(image.shape, self.tile_px):
+            tile = np.asarray(image[core])
+            tile_rows, tile_cols = np.nonzero(tile)
+            pixels.append(np.stack([
+                tile_rows + core[0].start, tile_cols + core[1].start,
+                tile[tile_rows, tile_cols]
+                ]))
+        return np.concatenate(pixels, axis=1)
+    
     def convert_linestrings(self, filename=None):
         """ Convert lines to geopandas linestrings """
         print('Converting linestrings')
@@ -1,7 +1,159 @@
 import numpy as np
 import pandas as pd
-from scipy.stats import norm, rankdata
+from scipy.stats import norm
 from scipy import spatial
+from pathlib import Path
+
+def clean_column_names(columns):
+    """Stripped, lower case column names with underscores for spaces and 
+    no brackets"""
+    return (
+        pd.Index(columns)
+        .str.strip()
+        .str.lower()
+        .str.replace(' ', '_')
+        .str.replace('(', '')
+        .str.replace(')', '')
+        )
+
+def project_columns(names, columns):
+    """Raw column names whose cleaned names are in columns (all names if
+    columns is None)"""
+    if columns is None:
+        return list(names)
+    cleaned = dict(zip(clean_column_names(names), names))
+    missing = [col for col in columns if col not in cleaned]
+    if missing:
+        raise KeyError('Columns not found: ' + ', '.join(missing))
+    return [cleaned[col] for col in columns]
+
+def downcast_floats(frame):
+    """Frame with float64 columns cast to float32"""
+    return frame.astype(
+        {col: np.float32 for col in frame.select_dtypes('float64').columns}
+        )
+
+def row_chunks(n_rows, chunk_rows):
+    """Slices of consecutive rows with at most chunk_rows each"""
+    for start in range(0, n_rows, chunk_rows):
+        yield slice(start, min(start + chunk_rows, n_rows))
+
+def sorted_values(chunks, n_values, memmap_path=None):
+    """Non-NaN values of a sequence of chunks sorted into one array, held
+    in a memmap at memmap_path if given"""
+    if memmap_path is None:
+        out = np.empty(n_values)
+    else:
+        out = np.memmap(memmap_path, dtype=float, mode='w+', shape=(n_values,))
+    pos = 0
+    for vals in chunks:
+        vals = vals[~np.isnan(vals)]
+        out[pos:pos+len(vals)] = vals
+        pos += len(vals)
+    out.sort()
+    return out
+
+def exact_score_table(sorted_vals, sorted_weights=None):
+    """Unique values and their van der Waerden scores rank/(n + 1), with 
+    tied values given their average rank as in scipy.stats.rankdata. With
+    weights (scaled to sum to n) the ranks are cumulative weights."""
+    n = len(sorted_vals)
+    starts = np.flatnonzero(
+        np.concatenate([[True], sorted_vals[1:] != sorted_vals[:-1]])
+        )
+    if sorted_weights is None:
+        counts = np.diff(np.append(starts, n))
+        return (np.asarray(sorted_vals[starts]), 
+                (starts + (counts + 1) / 2) / (n + 1))
+    
+    cum_weights = np.concatenate(
+        [[0.0], np.cumsum(sorted_weights * n / sorted_weights.sum())]
+        )
+    before = cum_weights[starts]
+    group = np.diff(np.append(before, cum_weights[-1]))
+    return (np.asarray(sorted_vals[starts]), 
+            (before + (group + 1) / 2) / (n + 1))
+
+def cell_declustering(x, y, vals, cell_sizes, n_offsets, anisotropy=1.0,
+                      minimize=True):
+    """
+    GSLIB declus cell declustering (Deutsch and Journel, 1998) over all 
+    cell sizes at once. For each size the points of every origin offset 
+    are hashed to integer cell keys and counted with one bincount, and 
+    weights are the mean inverse cell counts scaled to a mean of one. 
+    Returns the declustered mean of each size and the weights of the 
+    size with the minimum (or maximum) declustered mean.
+    """
+    x = x - x.min()
+    y = y - y.min()
+    shifts = np.arange(n_offsets)[:,None] / n_offsets
+    offset_idx = np.arange(n_offsets)[:,None]
+    means = np.zeros(len(cell_sizes))
+    best_weights = None
+    for k, size in enumerate(cell_sizes):
+        x_idx = np.floor(x / size + shifts).astype(np.int64)
+        y_idx = np.floor(y / (size * anisotropy) + shifts).astype(np.int64)
+        n_x, n_y = x_idx.max() + 1, y_idx.max() + 1
+        keys = (offset_idx * n_x + x_idx) * n_y + y_idx
+        if n_offsets * n_x * n_y > 10 * keys.size:
+            _, keys = np.unique(keys, return_inverse=True)
+        counts = np.bincount(keys.ravel())
+        weights = (1.0 / counts[keys]).mean(axis=0)
+        weights *= len(weights) / weights.sum()
+        means[k] = np.sum(weights * vals) / len(weights)
+        if (best_weights is None 
+                or (means[k] < best_mean if minimize else means[k] > best_mean)):
+            best_mean, best_weights = means[k], weights
+    return means, best_weights
+
+class TDigest(object):
+    """A mergeable t-digest quantile sketch (Dunning and Ertl, 2019), with 
+    centroids merged in one vectorised pass under the logistic (k2) scale 
+    function, which keeps the tails near exact"""
+
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = np.inf
+        self.max = -np.inf
+        self.n_values = 0
+
+    def update(self, values, weights=None):
+        if len(values) == 0:
+            return
+        if weights is None:
+            weights = np.ones(len(values))
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.n_values += len(values)
+        self.means = np.concatenate([self.means, values])
+        self.weights = np.concatenate([self.weights, weights])
+        self.compress()
+
+    def compress(self):
+        order = np.argsort(self.means, kind='stable')
+        means, weights = self.means[order], self.weights[order]
+        q_mid = (np.cumsum(weights) - weights / 2) / weights.sum()
+        normaliser = 4 * np.log(weights.sum() / self.compression) + 24
+        k = self.compression / normaliser * np.log(q_mid / (1 - q_mid))
+        group = np.floor(k - k[0]).astype(int)
+        self.weights = np.bincount(group, weights)
+        keep = self.weights > 0
+        self.means = np.bincount(group, means * weights)[keep] / self.weights[keep]
+        self.weights = self.weights[keep]
+
+    def score_table(self):
+        """Values and van der Waerden scores at the data extremes and the
+        centroid means"""
+        n = self.n_values
+        cdf = (np.cumsum(self.weights) - self.weights / 2) / self.weights.sum()
+        values = self.means
+        if self.min < values[0]:
+            values, cdf = np.append(self.min, values), np.append(0.0, cdf)
+        if self.max > values[-1]:
+            values, cdf = np.append(values, self.max), np.append(cdf, 1.0)
+        return values, (cdf * n + 0.5) / (n + 1)
 
 class GeostatsDataFrame(object):
     """A class to load an transform a table of xy + feature values into
@@ -10,24 +162,93 @@ class GeostatsDataFrame(object):
     coord_cols = {'x':'x', 'y':'y'}
     random_seed = np.random.seed(73073)
     nscore_epsilon = 1.0e-20
+    chunk_rows = 1000000
+    nscore_method = 'exact'
+    nscore_memmap_dir = None
+    tdigest_compression = 200
+    nscore_table_size = 1001
+    float32 = False
+    weight_col = None
+    declus_n_sizes = 50
+    declus_n_offsets = 25
+    declus_anisotropy = 1.0
+    declus_minimize = True
+    verbose = True
     
-    def __init__(self, filepath = None, pd_df = None):
+    def __init__(self, filepath = None, pd_df = None, columns = None):
+        """
+        Load a CSV, Parquet or Arrow (Feather) file, or a DataFrame. 
+        columns limits the load to those columns (cleaned names), e.g. the
+        coordinate and feature columns
+        """
         if filepath is not None:
-            self.input = pd.read_csv(filepath)
+            self.input = self.read_table(filepath, columns)
         
         if pd_df is not None:
             self.input = pd_df
         
-        self.input.columns = (
-            self.input.columns
-            .str.strip()
-            .str.lower()
-            .str.replace(' ', '_')
-            .str.replace('(', '')
-            .str.replace(')', '')
-            )
+        self.input.columns = clean_column_names(self.input.columns)
+        if columns is not None:
+            self.input = self.input[list(columns)]
+        if self.float32:
+            self.input = downcast_floats(self.input)
 
-        print(self.input.head())
+        if self.verbose:
+            print(self.input.head())
+        
+    @classmethod
+    def from_windows(cls, windows, columns = None, spacing = None):
+        """
+        Build a GeostatsDataFrame straight from a FractureTrace (or its 
+        windows table) without a CSV round trip. Non-geometry columns are 
+        wrapped without copying, x_coord and y_coord are set as the 
+        coordinates and the window step is kept as grid_spacing.
+        """
+        if hasattr(windows, 'windows'):
+            if spacing is None:
+                spacing = windows.window_step_increment_m
+            windows = windows.windows
+        if columns is None:
+            columns = [col for col in windows.columns 
+                       if str(windows[col].dtype) != 'geometry']
+        frame = pd.DataFrame(
+            {col: windows[col].to_numpy(copy=False) for col in columns}, 
+            copy=False
+            )
+        
+        gs_df = cls(pd_df = frame)
+        gs_df.set_coords(('x_coord', 'y_coord'))
+        if spacing is not None:
+            gs_df.grid_spacing = (float(spacing), float(spacing))
+            gs_df.input.attrs['grid_spacing'] = gs_df.grid_spacing
+        return gs_df
+        
+    def read_table(self, filepath, columns = None):
+        """Read only the requested columns of a Parquet or Arrow file, or
+        a CSV in chunks of chunk_rows that are downcast as they arrive"""
+        suffix = Path(filepath).suffix.lower()
+        if suffix in ('.parquet', '.pq'):
+            import pyarrow.parquet as pq
+            names = pq.read_schema(filepath).names
+            return pd.read_parquet(
+                filepath, columns=project_columns(names, columns)
+                )
+        
+        if suffix in ('.arrow', '.feather', '.ipc'):
+            import pyarrow.ipc as ipc
+            names = ipc.open_file(filepath).schema.names
+            return pd.read_feather(
+                filepath, columns=project_columns(names, columns)
+                )
+        
+        names = pd.read_csv(filepath, nrows=0).columns
+        reader = pd.read_csv(
+            filepath, usecols=project_columns(names, columns), 
+            chunksize=self.chunk_rows
+            )
+        chunks = [downcast_floats(chunk) if self.float32 else chunk 
+                  for chunk in reader]
+        return pd.concat(chunks, ignore_index=True)
         
     def set_coords(self, coord_tuple):
         """
@@ -38,60 +259,176 @@ class GeostatsDataFrame(object):
         self.input['x'] = self.input[coord_tuple[0]] - self.input[coord_tuple[0]].min() 
         self.coord_cols['y'] = coord_tuple[1]
         self.input['y'] = self.input[coord_tuple[1]] - self.input[coord_tuple[1]].min() 
-        print('Coordinate Columns:')
-        print(self.input[['x','y']].head())
+        if self.verbose:
+            print('Coordinate Columns:')
+            print(self.input[['x','y']].head())
         
     def set_features(self, feature_list):
         """Input a list of strings corresponding to desired feature columns"""
         self.feature_cols = feature_list
-        print('Feature Columns')
-        print(self.input.loc[:,self.feature_cols].head())
+        if self.verbose:
+            print('Feature Columns')
+            print(self.input.loc[:,self.feature_cols].head())
+        
+    def complete_rows(self, chunk):
+        """Feature values of a row chunk, with NaN for every feature of a
+        row that is missing any feature"""
+        vals = self.input[self.feature_cols].iloc[chunk].to_numpy(dtype=float, copy=True)
+        vals[np.isnan(vals).any(axis=1)] = np.nan
+        return vals
+
+    def row_weights(self, chunk):
+        """Declustering weights of a row chunk, ones if weight_col is None"""
+        if self.weight_col is None:
+            return np.ones(chunk.stop - chunk.start)
+        return np.nan_to_num(
+            self.output[self.weight_col].iloc[chunk].to_numpy(dtype=float)
+            )
+        
+    def declus(self, feature = None, cell_sizes = None):
+        """
+        Cell declustering weights for a feature (the first feature by 
+        default) over declus_n_sizes cell sizes, up to half the larger 
+        extent, and declus_n_offsets origin offsets. The optimal weights 
+        become the declus_weight column and the weight_col of the 
+        transforms.
+        """
+        if feature is None:
+            feature = self.feature_cols[0]
+        k = self.feature_cols.index(feature)
+        vals = np.concatenate([
+            self.complete_rows(chunk)[:,k] 
+            for chunk in row_chunks(len(self.input), self.chunk_rows)
+            ])
+        valid = ~np.isnan(vals)
+        x = self.input['x'].to_numpy(dtype=float)[valid]
+        y = self.input['y'].to_numpy(dtype=float)[valid]
+        
+        if cell_sizes is None:
+            extent = max(np.ptp(x), np.ptp(y))
+            cell_sizes = np.linspace(0, extent / 2, self.declus_n_sizes + 1)[1:]
+        means, weights = cell_declustering(
+            x, y, vals[valid], cell_sizes, self.declus_n_offsets, 
+            self.declus_anisotropy, self.declus_minimize
+            )
+        self.declus_summary = pd.DataFrame({
+            'cell_size': cell_sizes, 'declustered_mean': means
+            })
+        best = (np.argmin if self.declus_minimize else np.argmax)(means)
+        self.declus_cell_size = cell_sizes[best]
+        
+        declus_weight = np.full(len(vals), np.nan)
+        declus_weight[valid] = weights
+        self.output_columns({'declus_weight': declus_weight})
+        self.weight_col = 'declus_weight'
         
+        if self.verbose:
+            print('Declustering cell size: ' + str(self.declus_cell_size))
+            print('Naive mean: ' + str(vals[valid].mean())
+                  + ', declustered mean: ' + str(means[best]))
+        
+    def output_columns(self, columns):
+        """Add columns to output, starting from a shallow copy of input so
+        that neither table is copied or merged"""
+        if not hasattr(self, 'output'):
+            self.output = self.input.copy(deep=False)
+        dtype = np.float32 if self.float32 else float
+        for col, values in columns.items():
+            self.output[col] = values.astype(dtype)
+
     def z_scale_feats(self):
-        feat_df = self.input[self.feature_cols].dropna()
-        
-        # z-score transform
-        scaled_df = (feat_df - feat_df.mean())/feat_df.std()
-        scaled_df.columns = 'z_' + scaled_df.columns
-        self.zscore_cols = list(scaled_df.columns)
-        self.zscore_mean = np.array(feat_df.mean())
-        self.zscore_sd = np.array(feat_df.std())
-        
-        try:
-            self.output = pd.merge(
-                self.output, scaled_df, how='left', 
-                left_index = True, right_index = True
-                )
-        except:
-            self.output = pd.merge(
-                self.input, scaled_df, how='left', 
-                left_index = True, right_index = True
+        """Z-score transform in row chunks, with the means and standard 
+        deviations (weighted by weight_col if set) accumulated chunk by 
+        chunk"""
+        n_feats = len(self.feature_cols)
+        count, weight = 0, 0.0
+        total, total_sq = np.zeros(n_feats), np.zeros(n_feats)
+        for chunk in row_chunks(len(self.input), self.chunk_rows):
+            vals = self.complete_rows(chunk)
+            valid = ~np.isnan(vals[:,0])
+            weights = self.row_weights(chunk)[valid]
+            vals = vals[valid]
+            count += len(vals)
+            weight += weights.sum()
+            total += weights @ vals
+            total_sq += weights @ vals**2
+        self.zscore_mean = total / weight
+        self.zscore_sd = np.sqrt(
+            (total_sq / weight - self.zscore_mean**2) * count / (count - 1)
+            )
+        
+        scaled = np.full((len(self.input), n_feats), np.nan)
+        for chunk in row_chunks(len(self.input), self.chunk_rows):
+            scaled[chunk] = (
+                (self.complete_rows(chunk) - self.zscore_mean) / self.zscore_sd
                 )
+        self.zscore_cols = ['z_' + col for col in self.feature_cols]
+        self.output_columns(dict(zip(self.zscore_cols, scaled.T)))
+        
+        if self.verbose:
+            print('Created Z-score scaled features')
+            print(self.output[self.zscore_cols].head())
+
+    def nscore_lookup(self, k):
+        """Value to van der Waerden score table of feature k from a sorted
+        copy of its values (on disk when nscore_memmap_dir is set), or
+        from a t-digest when nscore_method is 'tdigest'. Weighted tables
+        (weight_col set) are sorted in memory."""
+        chunks = (self.complete_rows(chunk)[:,k] 
+                  for chunk in row_chunks(len(self.input), self.chunk_rows))
+        if self.nscore_method == 'tdigest':
+            digest = TDigest(self.tdigest_compression)
+            for chunk, vals in zip(
+                    row_chunks(len(self.input), self.chunk_rows), chunks):
+                valid = ~np.isnan(vals)
+                digest.update(vals[valid], self.row_weights(chunk)[valid])
+            return digest.score_table()
         
-        print('Created Z-score scaled features')
-        print(self.output[self.zscore_cols].head())
+        if self.weight_col is not None:
+            vals = np.concatenate(list(chunks))
+            weights = np.concatenate([
+                self.row_weights(chunk) 
+                for chunk in row_chunks(len(self.input), self.chunk_rows)
+                ])
+            valid = ~np.isnan(vals)
+            vals, weights = vals[valid], weights[valid]
+            order = np.argsort(vals, kind='stable')
+            return exact_score_table(vals[order], weights[order])
         
-    def n_transform_feats(self):
-        """ N-score transform using van der Waerden's method (Conover, 1999)"""
-        feat_df = self.input[self.feature_cols].dropna()
-        
-        norm_df = feat_df.apply(lambda x : norm.ppf(rankdata(x)/(len(x) + 1)))     
-        norm_df.columns = 'n_' + norm_df.columns
-        self.nscore_cols = list(norm_df.columns)
-        self.nscore_scores = feat_df.apply(lambda x : rankdata(x)/(len(x) + 1))
-        self.nscore_factor = np.array(
-            feat_df.apply(lambda x: x/norm_df['n_' + x.name])
+        if self.nscore_memmap_dir is None:
+            memmap_path = None
+        else:
+            Path(self.nscore_memmap_dir).mkdir(parents=True, exist_ok=True)
+            memmap_path = (Path(self.nscore_memmap_dir) 
+                           / ('nscore_' + self.feature_cols[k] + '.bin'))
+        n_values = int(self.input[self.feature_cols].notna().all(axis=1).sum())
+        return exact_score_table(
+            sorted_values(chunks, n_values, memmap_path)
             )
-        try:
-            self.output = pd.merge(
-                self.output, norm_df, how='left', 
-                left_index = True, right_index = True
-                )
-        except:
-            self.output = pd.merge(
-                self.input, norm_df, how='left', 
-                left_index = True, right_index = True
-                )
+
+    def n_transform_feats(self):
+        """ N-score transform using van der Waerden's method (Conover, 1999),
+        in row chunks through a value to score lookup table for each 
+        feature. nscore_tables keeps at most nscore_table_size rows of 
+        each table for back-transforming."""
+        nscores = np.full((len(self.input), len(self.feature_cols)), np.nan)
+        self.nscore_tables = {}
+        for k, feat in enumerate(self.feature_cols):
+            values, scores = self.nscore_lookup(k)
+            for chunk in row_chunks(len(self.input), self.chunk_rows):
+                nscores[chunk,k] = norm.ppf(
+                    np.interp(self.complete_rows(chunk)[:,k], values, scores)
+                    )
+            keep = np.unique(np.round(
+                np.linspace(0, len(values) - 1, self.nscore_table_size)
+                ).astype(int))
+            self.nscore_tables[feat] = pd.DataFrame({
+                'value': values[keep], 'score': scores[keep], 
+                'nscore': norm.ppf(scores[keep])
+                })
+        self.nscore_cols = ['n_' + col for col in self.feature_cols]
+        self.output_columns(dict(zip(self.nscore_cols, nscores.T)))
         
-        print('Created N-score transformed features')
-        print(self.output[self.nscore_cols].head())
\ No newline at end of file
+        if self.verbose:
+            print('Created N-score transformed features')
+            print(self.output[self.nscore_cols].head())
\ No newline at end of file
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import tifffile
+from skimage.color import rgb2gray, rgba2rgb
+
+def as_gray(raw):
+    """Grayscale image of raw pixels, converted as io.imread(as_gray=True)
+    would: colour images become 64-bit floats, gray images are unchanged"""
+    if raw.ndim == 2:
+        return raw
+    if raw.shape[-1] == 4:
+        return rgb2gray(rgba2rgb(raw))
+    if raw.shape[-1] == 3:
+        return rgb2gray(raw)
+    return raw[...,0]
+
+class TiffSource(object):
+    """
+    A lazily read, grayscale view of one pyramid level of a TIFF limited
+    to a region of interest (row_min, row_max, col_min, col_max).
+    Uncompressed images are memory-mapped; tiled or striped compressed
+    images decode only the segments under each requested slice.
+    """
+    
+    ndim = 2
+
+    def __init__(self, filepath, roi = None, level = 0):
+        self.tif = tifffile.TiffFile(filepath)
+        self.page = self.tif.series[0].levels[level].keyframe
+        n_rows, n_cols = self.page.imagelength, self.page.imagewidth
+        if roi is None:
+            roi = (0, n_rows, 0, n_cols)
+        self.roi = (max(roi[0], 0), min(roi[1], n_rows),
+                    max(roi[2], 0), min(roi[3], n_cols))
+        self.shape = (self.roi[1] - self.roi[0], self.roi[3] - self.roi[2])
+        self.samples = self.page.samplesperpixel
+        self.dtype = np.dtype(float if self.samples >= 3 else self.page.dtype)
+        
+        try:
+            self.memmap = tifffile.memmap(
+                filepath, series=0, level=level, mode='r'
+                )
+        except ValueError:
+            self.memmap = None
+        if self.memmap is not None and self.memmap.shape[:2] != (n_rows, n_cols):
+            self.memmap = None
+
+    def __getitem__(self, key):
+        rows, cols = [k.indices(n)[:2] for k, n in zip(key, self.shape)]
+        row_min, row_max = rows[0] + self.roi[0], rows[1] + self.roi[0]
+        col_min, col_max = cols[0] + self.roi[2], cols[1] + self.roi[2]
+        if self.memmap is not None:
+            raw = np.asarray(self.memmap[row_min:row_max, col_min:col_max])
+        else:
+            raw = self.read_region(row_min, row_max, col_min, col_max)
+        return as_gray(raw)
+
+    def __array__(self, dtype = None, copy = None):
+        img = self[:,:]
+        return img if dtype is None else img.astype(dtype)
+
+    def read_region(self, row_min, row_max, col_min, col_max):
+        """Decode the tiles or strips of the page that overlap a region"""
+        page = self.page
+        if page.planarconfig == 2 and self.samples > 1:
+            return page.asarray()[:,row_min:row_max, col_min:col_max].transpose(1, 2, 0)
+        if page.is_tiled:
+            seg_rows, seg_cols = page.tilelength, page.tilewidth
+        else:
+            seg_rows, seg_cols = page.rowsperstrip, page.imagewidth
+        n_across = -(-page.imagewidth // seg_cols)
+        
+        out = np.empty(
+            (row_max - row_min, col_max - col_min, self.samples),
+            dtype=page.dtype
+            )
+        decode = page.decode
+        file_handle = self.tif.filehandle
+        for seg_row in range(row_min // seg_rows, (row_max - 1) // seg_rows + 1):
+            for seg_col in range(col_min // seg_cols, (col_max - 1) // seg_cols + 1):
+                index = seg_row * n_across + seg_col
+                file_handle.seek(page.dataoffsets[index])
+                data = file_handle.read(page.databytecounts[index])
+                segment = decode(data, index, jpegtables=page.jpegtables)[0]
+                segment = segment.reshape(segment.shape[-3:])
+                
+                top, left = seg_row * seg_rows, seg_col * seg_cols
+                r0, r1 = max(row_min, top), min(row_max, top + segment.shape[0])
+                c0, c1 = max(col_min, left), min(col_max, left + segment.shape[1])
+                out[r0 - row_min:r1 - row_min, c0 - col_min:c1 - col_min] = (
+                    segment[r0 - top:r1 - top, c0 - left:c1 - left]
+                    )
+        return out[...,0] if self.samples == 1 else out
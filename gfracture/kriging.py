@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import math
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from scipy import spatial
+from pathlib import Path
+from gfracture.variogram import nested_model
+
+def model_from_fit(fit):
+    """Kriging model from a row of Variogram.variogram_models or
+    Variogram.anisotropy_model"""
+    if 'major_range' in fit:
+        return {
+            'structures': [fit['structure']], 'nugget': fit['nugget'],
+            'sills': [fit['sill']], 'ranges': [fit['major_range']],
+            'major_azimuth': fit['major_azimuth'],
+            'anisotropy_ratio': fit['minor_range']/fit['major_range']
+            }
+    
+    structures = fit['structures'].split('+')
+    return {
+        'structures': structures, 'nugget': fit['nugget'],
+        'sills': [fit['sill_' + str(k+1)] for k in range(len(structures))],
+        'ranges': [fit['range_' + str(k+1)] for k in range(len(structures))],
+        'major_azimuth': 0.0, 'anisotropy_ratio': 1.0
+        }
+
+def anisotropic_distance(x_dist, y_dist, major_azimuth, anisotropy_ratio):
+    """Lag distance with the minor axis stretched to the major axis, for
+    a major azimuth measured clockwise from NS in degrees"""
+    azimuth = major_azimuth * math.pi / 180.0
+    major_dist = x_dist * math.sin(azimuth) + y_dist * math.cos(azimuth)
+    minor_dist = x_dist * math.cos(azimuth) - y_dist * math.sin(azimuth)
+    return np.hypot(major_dist, minor_dist / anisotropy_ratio)
+
+def model_covariance(x_dist, y_dist, model):
+    """Covariance of a kriging model at the given lags"""
+    h = anisotropic_distance(
+        x_dist, y_dist, model['major_azimuth'], model['anisotropy_ratio']
+        )
+    return model['nugget'] + sum(model['sills']) - nested_model(
+        h, model['structures'], model['nugget'], model['sills'], 
+        model['ranges']
+        )
+
+class OrdinaryKriging(object):
+    """A class to krige a feature of a GeostatsDataFrame onto a grid with
+    a fitted variogram model, using KD-tree neighbourhoods and batched
+    solves of the kriging systems"""
+    
+    n_neighbours = 16
+    search_radius = np.inf
+    chunk_size = 20000
+    save_figures = True
+    show_figures = True
+    output_path = './output/'
+
+    def __init__(self, geostats_df, val_col_str, model):
+        self.gs_df = geostats_df
+        self.val_col = val_col_str
+        self.model = dict(
+            {'major_azimuth': 0.0, 'anisotropy_ratio': 1.0}, **model
+            )
+        self.total_sill = self.model['nugget'] + sum(self.model['sills'])
+        
+        frame = (geostats_df.output if hasattr(geostats_df, 'output')
+                 else geostats_df.input)
+        data = frame[['x', 'y', self.val_col]].dropna()
+        self.data_xy = data[['x', 'y']].to_numpy(dtype=float)
+        self.data_vals = data[self.val_col].to_numpy(dtype=float)
+        self.tree = spatial.cKDTree(self.data_xy)
+        
+        print(str(len(data)) + ' data points for kriging')
+
+    def set_output_path(self, path):
+        self.output_path = path
+        Path(self.output_path).mkdir(parents=True, exist_ok=True)
+
+    def covariance(self, x_dist, y_dist):
+        """Covariance of the model at the given lags"""
+        return model_covariance(x_dist, y_dist, self.model)
+
+    def make_grid(self, spacing):
+        """Regular grid of target nodes over the extent of the data"""
+        x_nodes = np.arange(0, self.data_xy[:,0].max() + spacing/2, spacing)
+        y_nodes = np.arange(0, self.data_xy[:,1].max() + spacing/2, spacing)
+        x, y = np.meshgrid(x_nodes, y_nodes)
+        self.grid_spacing = spacing
+        self.grid_shape = x.shape
+        self.grid_xy = np.column_stack([x.ravel(), y.ravel()])
+
+    def solve_systems(self, targets, neighbours):
+        """Estimates and kriging variances for targets that share the same
+        number of neighbours, with all systems solved in one batch"""
+        n_targets, n_nbrs = neighbours.shape
+        nbr_xy = self.data_xy[neighbours]
+        
+        lhs = np.ones((n_targets, n_nbrs + 1, n_nbrs + 1))
+        lhs[:,-1,-1] = 0.0
+        lhs[:,:n_nbrs,:n_nbrs] = self.covariance(
+            nbr_xy[:,:,None,0] - nbr_xy[:,None,:,0],
+            nbr_xy[:,:,None,1] - nbr_xy[:,None,:,1]
+            )
+        
+        rhs = np.ones((n_targets, n_nbrs + 1))
+        rhs[:,:n_nbrs] = self.covariance(
+            nbr_xy[:,:,0] - targets[:,None,0],
+            nbr_xy[:,:,1] - targets[:,None,1]
+            )
+        
+        weights = np.linalg.solve(lhs, rhs[...,None])[...,0]
+        estimate = np.sum(weights[:,:n_nbrs] * self.data_vals[neighbours], axis=1)
+        variance = self.total_sill - np.sum(weights * rhs, axis=1)
+        return estimate, variance
+
+    def krige(self, targets=None):
+        """Krige the target nodes (grid_xy by default) in chunks, grouping
+        the targets of each chunk by their neighbour count"""
+        if targets is None:
+            targets = self.grid_xy
+        n_nbrs = min(self.n_neighbours, len(self.data_xy))
+        estimate = np.full(len(targets), np.nan)
+        variance = np.full(len(targets), np.nan)
+        
+        for start in range(0, len(targets), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            _, neighbours = self.tree.query(
+                targets[chunk], k=n_nbrs,
+                distance_upper_bound=self.search_radius, workers=-1
+                )
+            neighbours = neighbours.reshape(-1, n_nbrs)
+            found = neighbours < len(self.data_xy)
+            n_found = found.sum(axis=1)
+            
+            # cKDTree returns neighbours nearest first, so the found ones
+            # lead each row
+            for count in np.unique(n_found[n_found > 0]):
+                rows = np.flatnonzero(n_found == count)
+                chunk_est, chunk_var = self.solve_systems(
+                    targets[chunk][rows], neighbours[rows,:count]
+                    )
+                estimate[start + rows] = chunk_est
+                variance[start + rows] = chunk_var
+        
+        self.estimates = pd.DataFrame({
+            'x': targets[:,0], 'y': targets[:,1],
+            'estimate': estimate, 'variance': variance
+            })
+        
+        print('Kriged ' + str(len(targets)) + ' nodes')
+
+    def write_estimates(self):
+        self.estimates.to_csv(self.output_path+'kriging_estimates.csv')
+
+    def plot_estimates(self, column='estimate'):
+        plt.imshow(
+            self.estimates[column].to_numpy().reshape(self.grid_shape),
+            origin='lower', cmap=plt.get_cmap('plasma'),
+            extent=(self.grid_xy[:,0].min(), self.grid_xy[:,0].max(),
+                    self.grid_xy[:,1].min(), self.grid_xy[:,1].max())
+            )
+        plt.colorbar()
+        plt.xlabel(r'x (m)')
+        plt.ylabel(r'y (m)')
+        plt.title('Kriging ' + column + ': ' + self.val_col)
+        if self.save_figures:
+            plt.savefig(self.output_path+'kriging_'+column+'.pdf')
+            plt.savefig(self.output_path+'kriging_'+column+'.png')
+        if self.show_figures:
+            plt.show()
+        else:
+            plt.close()
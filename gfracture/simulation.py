@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from gfracture.kriging import OrdinaryKriging, model_covariance
+
+def nscore_table(geostats_df, feature):
+    """Sorted (normal score, value) pairs of a feature from the
+    nscore_tables of a GeostatsDataFrame, for back-transforming"""
+    table = geostats_df.nscore_tables[feature]
+    return (table['nscore'].to_numpy(dtype=float),
+            table['value'].to_numpy(dtype=float))
+
+def back_transform(gaussian, table):
+    """Normal scores to feature values by linear interpolation of the
+    nscore table, clamped to the data minimum and maximum in the tails"""
+    return np.interp(gaussian, table[0], table[1])
+
+def node_data(data_xy, grid_shape, spacing, pad):
+    """Index of the datum on each node of a grid padded by pad cells, or
+    -1 for nodes without one"""
+    n_rows, n_cols = grid_shape
+    col, row = [np.rint(data_xy[:,k] / spacing).astype(np.int64) for k in (0, 1)]
+    on_node = ((np.abs(data_xy[:,0] - col * spacing) <= 1e-6 * spacing)
+               & (np.abs(data_xy[:,1] - row * spacing) <= 1e-6 * spacing)
+               & (row >= 0) & (row < n_rows) & (col >= 0) & (col < n_cols))
+    datum = np.full((n_rows + 2*pad) * (n_cols + 2*pad), -1, dtype=np.int64)
+    datum[(row[on_node] + pad) * (n_cols + 2*pad) + col[on_node] + pad] = np.flatnonzero(on_node)
+    return datum
+
+def search_template(model, spacing, n_cells):
+    """Grid offsets within n_cells of a node, nearest first in the
+    anisotropic distance of the model"""
+    offsets = np.arange(-n_cells, n_cells + 1)
+    d_row, d_col = [a.ravel() for a in np.meshgrid(offsets, offsets, indexing='ij')]
+    keep = (d_row != 0) | (d_col != 0)
+    d_row, d_col = d_row[keep], d_col[keep]
+    cov = model_covariance(d_col * spacing, d_row * spacing, model)
+    order = np.lexsort((np.hypot(d_row, d_col), -cov))
+    return d_row[order], d_col[order]
+
+_sgs_data = {}
+
+def _init_sgs_worker(data):
+    _sgs_data.clear()
+    _sgs_data.update(data)
+
+def _simulate_realization(seed):
+    """One realization along a random path, with simple kriging in normal
+    score space from the nearest data and previously simulated nodes"""
+    d = _sgs_data
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols = d['grid_shape']
+    pad = d['template_cells']
+    n_padded_cols = n_cols + 2*pad
+    
+    template_flat = d['template_rows'] * n_padded_cols + d['template_cols']
+    template_xy = np.column_stack([d['template_cols'], d['template_rows']]) * d['spacing']
+    simulated = np.zeros((n_rows + 2*pad) * n_padded_cols, dtype=bool)
+    sim_values = np.zeros((n_rows + 2*pad) * n_padded_cols)
+    n_data = len(d['data_vals'])
+    sill = model_covariance(0.0, 0.0, d['model'])
+    
+    path = rng.permutation(n_rows * n_cols)
+    deviates = rng.standard_normal(n_rows * n_cols)
+    for node, deviate in zip(path, deviates):
+        row, col = divmod(node, n_cols)
+        node_xy = d['grid_xy'][node]
+        padded_node = (row + pad) * n_padded_cols + col + pad
+        
+        data_nbrs = d['data_nbrs'][node]
+        data_nbrs = data_nbrs[data_nbrs < n_data]
+        candidates = padded_node + template_flat
+        found = np.flatnonzero(simulated[candidates])
+        # a node on a datum already in the search would repeat its row
+        # of the kriging system and make it singular
+        found = found[~np.isin(d['node_data'][candidates[found]], data_nbrs)]
+        found = found[:d['n_node_neighbours']]
+        
+        nbr_xy = np.concatenate([d['data_xy'][data_nbrs], node_xy + template_xy[found]])
+        nbr_vals = np.concatenate([d['data_vals'][data_nbrs], sim_values[candidates[found]]])
+        
+        if len(nbr_vals) == 0:
+            mean, variance = 0.0, sill
+        else:
+            lhs = model_covariance(
+                nbr_xy[:,None,0] - nbr_xy[None,:,0],
+                nbr_xy[:,None,1] - nbr_xy[None,:,1], d['model']
+                )
+            rhs = model_covariance(
+                nbr_xy[:,0] - node_xy[0], nbr_xy[:,1] - node_xy[1], d['model']
+                )
+            weights = np.linalg.solve(lhs, rhs)
+            mean = weights @ nbr_vals
+            variance = max(sill - weights @ rhs, 0.0)
+        
+        sim_values[padded_node] = mean + np.sqrt(variance) * deviate
+        simulated[padded_node] = True
+    
+    gaussian = sim_values.reshape(n_rows + 2*pad, n_padded_cols)[pad:-pad or None, pad:-pad or None]
+    return back_transform(gaussian, d['nscore_table']).astype(np.float32)
+
+class SequentialGaussianSimulation(OrdinaryKriging):
+    """A class to simulate realizations of a feature of a GeostatsDataFrame
+    on a grid by sequential Gaussian simulation of its normal scores, with
+    independent realizations run in a process pool"""
+    
+    n_realizations = 100
+    n_jobs = 1
+    random_seed = 73073
+    n_data_neighbours = 8
+    n_node_neighbours = 12
+    template_cells = 16
+
+    def __init__(self, geostats_df, feature, model):
+        """The model is a variogram model of the normal scores, from
+        GeostatsDataFrame.n_transform_feats"""
+        super().__init__(geostats_df, 'n_' + feature, model)
+        self.feature = feature
+        self.nscore_table = nscore_table(geostats_df, feature)
+
+    def simulate(self):
+        """Simulate n_realizations on grid_xy, with a seed for each
+        realization spawned from random_seed so results do not depend on
+        n_jobs"""
+        _, data_nbrs = self.tree.query(
+            self.grid_xy, k=min(self.n_data_neighbours, len(self.data_xy)),
+            distance_upper_bound=self.search_radius, workers=-1
+            )
+        template_rows, template_cols = search_template(
+            self.model, self.grid_spacing, self.template_cells
+            )
+        data = {
+            'grid_xy': self.grid_xy, 'grid_shape': self.grid_shape,
+            'spacing': self.grid_spacing, 'data_xy': self.data_xy,
+            'data_vals': self.data_vals,
+            'data_nbrs': data_nbrs.reshape(len(self.grid_xy), -1),
+            'template_rows': template_rows, 'template_cols': template_cols,
+            'template_cells': self.template_cells,
+            'node_data': node_data(
+                self.data_xy, self.grid_shape, self.grid_spacing, 
+                self.template_cells
+                ),
+            'n_node_neighbours': self.n_node_neighbours,
+            'model': self.model, 'nscore_table': self.nscore_table
+            }
+        seeds = np.random.SeedSequence(self.random_seed).spawn(self.n_realizations)
+        
+        if self.n_jobs > 1:
+            with ProcessPoolExecutor(
+                    self.n_jobs, initializer=_init_sgs_worker, initargs=(data,)
+                    ) as pool:
+                realizations = list(pool.map(_simulate_realization, seeds))
+        else:
+            _init_sgs_worker(data)
+            realizations = [_simulate_realization(seed) for seed in seeds]
+        
+        self.realizations = np.stack(realizations)
+        self.summary = pd.DataFrame({
+            'x': self.grid_xy[:,0], 'y': self.grid_xy[:,1],
+            'etype_mean': self.realizations.mean(axis=0).ravel(),
+            'etype_variance': self.realizations.var(axis=0).ravel()
+            })
+        
+        print('Simulated ' + str(self.n_realizations) + ' realizations of '
+              + str(len(self.grid_xy)) + ' nodes')
+
+    def write_realizations(self):
+        np.save(self.output_path+'sgs_realizations.npy', self.realizations)
+        self.summary.to_csv(self.output_path+'sgs_summary.csv')
+
+    def plot_realization(self, realization=0):
+        plt.imshow(
+            self.realizations[realization], origin='lower',
+            cmap=plt.get_cmap('plasma'),
+            extent=(self.grid_xy[:,0].min(), self.grid_xy[:,0].max(),
+                    self.grid_xy[:,1].min(), self.grid_xy[:,1].max())
+            )
+        plt.colorbar()
+        plt.xlabel(r'x (m)')
+        plt.ylabel(r'y (m)')
+        plt.title('SGS realization ' + str(realization) + ': ' + self.feature)
+        if self.save_figures:
+            plt.savefig(self.output_path+'sgs_realization_'+str(realization)+'.pdf')
+            plt.savefig(self.output_path+'sgs_realization_'+str(realization)+'.png')
+        if self.show_figures:
+            plt.show()
+        else:
+            plt.close()
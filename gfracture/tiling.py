@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import tempfile
+from collections import deque
+from functools import partial
+from pathlib import Path
+from scipy import ndimage as ndi
+from scipy import spatial
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage import util
+
+def halo_slices(core, shape, halo):
+    """Padded and inner slices of a core tile: padded is the core plus up
+    to halo pixels of context clipped to the image shape, and inner the 
+    core within the padded tile"""
+    padded = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, n))
+                   for s, n in zip(core, shape))
+    inner = tuple(slice(s.start - p.start, s.stop - p.start)
+                  for s, p in zip(core, padded))
+    return padded, inner
+
+def tile_slices(shape, tile_px, halo=0):
+    """Slices of square tiles of tile_px over an image shape as (core, 
+    padded, inner) tuples, see halo_slices"""
+    for row in range(0, shape[0], tile_px):
+        for col in range(0, shape[1], tile_px):
+            core = (slice(row, min(row + tile_px, shape[0])),
+                    slice(col, min(col + tile_px, shape[1])))
+            yield (core,) + halo_slices(core, shape, halo)
+
+def stage_array(shape, dtype, tile_dir=None, name=None):
+    """Output array for a tiled stage, memory-mapped to a temporary file
+    in tile_dir if set, which is deleted with the array"""
+    if tile_dir is None:
+        return np.zeros(shape, dtype=dtype)
+    Path(tile_dir).mkdir(parents=True, exist_ok=True)
+    # a file per array, so stages and images never share a mapping
+    return np.memmap(
+        tempfile.TemporaryFile(prefix=name + '_', suffix='.dat', dir=tile_dir),
+        dtype=dtype, mode='w+', shape=shape
+        )
+
+def apply_core(func, tile, inner):
+    """Core of func applied to a padded tile"""
+    return func(tile)[inner]
+
+def imap_tiles(func, image, tile_px, halo, pool=None, n_jobs=1):
+    """
+    (core, func(padded tile, inner)) for each tile in order. With a
+    process pool at most 2 * n_jobs tiles are in flight, so memory stays
+    bounded by the tile size.
+    """
+    tiles = tile_slices(image.shape, tile_px, halo)
+    if pool is None:
+        for core, padded, inner in tiles:
+            yield core, func(np.asarray(image[padded]), inner)
+        return
+    
+    pending = deque()
+    for core, padded, inner in tiles:
+        pending.append(
+            (core, pool.submit(func, np.asarray(image[padded]), inner))
+            )
+        if len(pending) >= 2 * n_jobs:
+            core, future = pending.popleft()
+            yield core, future.result()
+    while pending:
+        core, future = pending.popleft()
+        yield core, future.result()
+
+def map_tiles(func, image, out, tile_px, halo, pool=None, n_jobs=1):
+    """Apply func (picklable when pooled) to each tile of image with a 
+    halo of context and write the core of the result to out"""
+    for core, result in imap_tiles(
+            partial(apply_core, func), image, tile_px, halo, pool, n_jobs):
+        out[core] = result
+    return out
+
+def tile_min_max(image, tile_px):
+    """Minimum and maximum of an image read tile by tile"""
+    low, high = np.inf, -np.inf
+    for core, _, _ in tile_slices(image.shape, tile_px):
+        tile = np.asarray(image[core])
+        low, high = min(low, tile.min()), max(high, tile.max())
+    return low, high
+
+def tile_std(image, tile_px):
+    """Standard deviation of an image read tile by tile, on the float 
+    scale (util.img_as_float) that skimage filters work on"""
+    count, total, total_sq = 0, 0.0, 0.0
+    for core, _, _ in tile_slices(image.shape, tile_px):
+        tile = util.img_as_float(np.asarray(image[core]))
+        count += tile.size
+        total += tile.sum()
+        total_sq += np.sum(tile**2)
+    return np.sqrt(max(total_sq / count - (total / count)**2, 0.0))
+
+def seam_pairs(before, after, connectivity):
+    """Label pairs that touch across a seam between two rows (or columns)
+    of labels"""
+    shifts = [0] if connectivity == 1 else [-1, 0, 1]
+    pairs = []
+    for shift in shifts:
+        a = before[max(-shift, 0):len(before) - max(shift, 0)]
+        b = after[max(shift, 0):len(after) - max(-shift, 0)]
+        touch = (a > 0) & (b > 0)
+        pairs.append(np.column_stack([a[touch], b[touch]]))
+    return np.concatenate(pairs)
+
+def label_tile(tile, inner, tile_mask, connectivity):
+    """Labels of one tile, the raster index (in the tile) of the first
+    pixel of each label and the flag of each label if tile_mask gives a
+    (mask, flag) tuple"""
+    mask, flag = tile_mask(tile), None
+    if isinstance(mask, tuple):
+        mask, flag = mask[0][inner], mask[1][inner]
+    else:
+        mask = mask[inner]
+    structure = ndi.generate_binary_structure(2, connectivity)
+    tile_labels, n_labels = ndi.label(mask, structure)
+    _, first = np.unique(tile_labels.ravel(), return_index=True)
+    if flag is not None:
+        flag = np.bincount(tile_labels[flag], minlength=n_labels + 1)[1:] > 0
+    return tile_labels, n_labels, first[1:] if tile_labels.min() == 0 else first, flag
+
+def label_tiles(tile_mask, image, tile_px, labels, connectivity=1, halo=0,
+                pool=None, n_jobs=1):
+    """Label a binary image tile by tile into labels (provisional), where
+    tile_mask(padded tile) gives the mask or a (mask, flag) tuple. Returns
+    the provisional to final label map and the final label flags (None 
+    without flags)."""
+    shape = image.shape
+    offset = 0
+    first_pixel, flagged = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=bool)]
+    worker = partial(label_tile, tile_mask=tile_mask, connectivity=connectivity)
+    # label each tile on its own, numbering after the previous tiles
+    for core, (tile_labels, n_labels, first, flag) in imap_tiles(
+            worker, image, tile_px, halo, pool, n_jobs):
+        # raster position of the first pixel of each tile label, so that
+        # merged components keep the numbering of a whole-image label
+        rows, cols = np.divmod(first, tile_labels.shape[1])
+        first_pixel.append((rows + core[0].start) * shape[1] + cols + core[1].start)
+        if flag is not None:
+            flagged.append(flag)
+        
+        tile_labels[tile_labels > 0] += offset
+        labels[core] = tile_labels
+        offset += n_labels
+    
+    # merge components that touch across tile seams as a sparse graph
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for row in range(tile_px, shape[0], tile_px):
+        pairs.append(seam_pairs(
+            np.asarray(labels[row - 1]), np.asarray(labels[row]), connectivity
+            ))
+    for col in range(tile_px, shape[1], tile_px):
+        pairs.append(seam_pairs(
+            np.asarray(labels[:,col - 1]), np.asarray(labels[:,col]), connectivity
+            ))
+    pairs = np.concatenate(pairs)
+    graph = coo_matrix(
+        (np.ones(len(pairs)), (pairs[:,0], pairs[:,1])),
+        shape=(offset + 1, offset + 1)
+        )
+    _, components = connected_components(graph, directed=False)
+    
+    # number final labels by their first pixel, as scipy.ndimage.label
+    first_pixel = np.concatenate(first_pixel)
+    first_pixel[0] = -1
+    component_first = np.full(components.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(component_first, components, first_pixel)
+    rank = np.empty(len(component_first), dtype=np.int64)
+    rank[np.argsort(component_first)] = np.arange(len(component_first))
+    label_map = rank[components]
+    
+    if len(flagged) == 1:
+        return label_map, None
+    label_flag = np.zeros(len(component_first), dtype=bool)
+    np.logical_or.at(label_flag, label_map, np.concatenate(flagged))
+    label_flag[0] = False
+    return label_map, label_flag
+
+def relabel_tiles(labels, label_map, tile_px, out=None):
+    """Map provisional labels to final labels (or flags) tile by tile"""
+    if out is None:
+        out = labels
+    for core, _, _ in tile_slices(labels.shape, tile_px):
+        out[core] = label_map[np.asarray(labels[core])]
+    return out
+
+def clip_segments(segments, box):
+    """
+    Liang-Barsky clipping of segments, an (n, 2, 2) array of (x, y) end
+    points, to a box (x_min, x_max, y_min, y_max). Returns the clipped
+    segments that intersect the box.
+    """
+    start, delta = segments[:,0], segments[:,1] - segments[:,0]
+    t_min, t_max = np.zeros(len(segments)), np.ones(len(segments))
+    for axis, low, high in [(0, box[0], box[1]), (1, box[2], box[3])]:
+        for p, q in [(-delta[:,axis], start[:,axis] - low),
+                     (delta[:,axis], high - start[:,axis])]:
+            parallel = p == 0
+            t_max[parallel & (q < 0)] = -1.0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = q / p
+            t_min = np.where(~parallel & (p < 0), np.maximum(t_min, r), t_min)
+            t_max = np.where(~parallel & (p > 0), np.minimum(t_max, r), t_max)
+    keep = t_min <= t_max
+    return np.stack([start + t_min[:,None] * delta,
+                     start + t_max[:,None] * delta], axis=1)[keep]
+
+def merge_seam_segments(segments, seams_x, seams_y, tol_px=2.0, 
+                        angle_tol_deg=10.0):
+    """
+    Join segments that were clipped at tile seams: end points on a seam
+    within tol_px of an end point of another segment at a similar angle
+    are linked, and each linked group becomes the segment between its two
+    furthest end points.
+    """
+    if len(segments) == 0:
+        return segments.reshape(-1, 2, 2)
+    ends = segments.reshape(-1, 2)
+    on_seam = (np.isin(np.round(ends[:,0], 6), np.round(seams_x, 6))
+               | np.isin(np.round(ends[:,1], 6), np.round(seams_y, 6)))
+    seam_idx = np.flatnonzero(on_seam)
+    pairs = spatial.cKDTree(ends[seam_idx]).query_pairs(tol_px, output_type='ndarray')
+    seg_pairs = seam_idx[pairs] // 2
+    seg_pairs = seg_pairs[seg_pairs[:,0] != seg_pairs[:,1]]
+    
+    delta = segments[:,1] - segments[:,0]
+    angle = np.degrees(np.arctan2(delta[:,1], delta[:,0])) % 180
+    angle_diff = np.abs(angle[seg_pairs[:,0]] - angle[seg_pairs[:,1]])
+    seg_pairs = seg_pairs[np.minimum(angle_diff, 180 - angle_diff) <= angle_tol_deg]
+    
+    graph = coo_matrix(
+        (np.ones(len(seg_pairs)), (seg_pairs[:,0], seg_pairs[:,1])),
+        shape=(len(segments), len(segments))
+        )
+    n_groups, groups = connected_components(graph, directed=False)
+    merged = []
+    for group in np.split(np.argsort(groups, kind='stable'), 
+                          np.cumsum(np.bincount(groups))[:-1]):
+        if len(group) == 1:
+            merged.append(segments[group[0]])
+            continue
+        points = segments[group].reshape(-1, 2)
+        dist = spatial.distance.squareform(spatial.distance.pdist(points))
+        i, j = np.unravel_index(np.argmax(dist), dist.shape)
+        merged.append(points[[i, j]])
+    return np.array(merged).reshape(-1, 2, 2)
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import itertools
+import json
 import math
 import numpy as np
 import pandas as pd
+import scipy.fft as sfft
 import scipy.spatial.distance as ssd
+from scipy.stats import norm
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 def calc_row_idx(k, n):
@@ -15,6 +21,418 @@ def elem_in_i_rows(i, n):
 def calc_col_idx(k, i, n):
     return int(n - elem_in_i_rows(i + 1, n) + k)
 
+def condensed_row_pairs(start, stop, n):
+    """Point indices (i < j) of the condensed pairs in rows start:stop
+    of an n x n distance matrix"""
+    rows = np.arange(start, stop)
+    counts = n - 1 - rows
+    pt_1 = np.repeat(rows, counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    pt_2 = np.arange(len(pt_1)) - first + pt_1 + 1
+    return pt_1, pt_2
+
+def split_row_blocks(n, block_pairs):
+    """Split the rows of an n x n condensed distance matrix into blocks
+    of roughly block_pairs pairs each"""
+    n_pairs = n * (n - 1) // 2
+    n_blocks = max(1, int(math.ceil(n_pairs / block_pairs)))
+    rows_before = elem_in_i_rows(np.arange(n + 1), n)
+    bounds = np.unique(
+        np.searchsorted(rows_before, np.linspace(0, n_pairs, n_blocks + 1))
+        )
+    return list(zip(bounds[:-1], bounds[1:]))
+
+PAIR_COLUMNS = ('pt_1', 'pt_2', 'xy_dist', 'x_dist', 'y_dist')
+
+def spherical_model(h, range_):
+    r = np.minimum(h/range_, 1.0)
+    return 1.5*r - 0.5*r**3
+
+def exponential_model(h, range_):
+    return 1.0 - np.exp(-3.0*h/range_)
+
+def gaussian_model(h, range_):
+    return 1.0 - np.exp(-3.0*(h/range_)**2)
+
+VARIOGRAM_MODELS = {
+    'spherical': spherical_model,
+    'exponential': exponential_model,
+    'gaussian': gaussian_model
+    }
+
+def nested_model(h, structures, nugget, sills, ranges):
+    """Semivariance at lags h of a nugget plus nested unit structures 
+    (names in VARIOGRAM_MODELS) with the given sills and practical ranges"""
+    h = np.asarray(h, dtype=float)
+    gamma = np.where(h > 0, nugget, 0.0)
+    for structure, sill, range_ in zip(structures, sills, ranges):
+        gamma = gamma + sill*VARIOGRAM_MODELS[structure](h, range_)
+    return gamma
+
+def batch_wls(design, semivariance, weights):
+    """Non-negative weighted least squares fits of semivariance for a batch
+    of designs (... x lag x coefficient). Returns the coefficients and 
+    weighted sum of squared errors, which are NaN and inf where no 
+    non-negative fit exists."""
+    batch_shape, (n_lags, n_coef) = design.shape[:-2], design.shape[-2:]
+    semivariance = np.broadcast_to(semivariance, design.shape[:-1]).reshape(-1, n_lags)
+    weights = np.broadcast_to(weights, design.shape[:-1]).reshape(-1, n_lags)
+    design = design.reshape(-1, n_lags, n_coef)
+    best_coef = np.full((len(design), n_coef), np.nan)
+    best_wsse = np.full(len(design), np.inf)
+    
+    # where the full fit has a negative coefficient, solve every subset of
+    # free coefficients with the rest fixed at 0 and keep the best 
+    # non-negative one: the exact NNLS solution for the few coefficients
+    # of a nested model
+    subsets = sorted(
+        itertools.product((True, False), repeat=n_coef), key=sum, reverse=True
+        )
+    todo = np.arange(len(design))
+    for free in map(np.array, subsets[:-1]):
+        sub_design = design[:,:,free]
+        weighted = sub_design * weights[...,None]
+        normal = np.einsum('...lp,...lq->...pq', weighted, sub_design)
+        ridge = 1e-12 * np.trace(normal, axis1=-2, axis2=-1)[...,None,None]
+        coef = np.zeros((len(todo), n_coef))
+        coef[:,free] = np.linalg.solve(
+            normal + ridge*np.eye(free.sum()),
+            np.einsum('...lp,...l->...p', weighted, semivariance)[...,None]
+            )[...,0]
+        
+        resid = semivariance - np.einsum('...lp,...p->...l', design, coef)
+        wsse = np.sum(weights * resid**2, axis=-1)
+        better = (coef >= 0).all(axis=-1) & (wsse < best_wsse[todo])
+        best_coef[todo[better]] = coef[better]
+        best_wsse[todo[better]] = wsse[better]
+        if free.all():
+            todo = todo[~better]
+            design, weights = design[~better], weights[~better]
+            semivariance = semivariance[~better]
+    return (best_coef.reshape(batch_shape + (n_coef,)), 
+            best_wsse.reshape(batch_shape))
+
+def fit_nested_models(lags, semivariance, weights, structures, range_fracs,
+                      fit_nugget=True):
+    """Fit a nugget and nested structures to a batch of experimental curves
+    (curve x lag arrays, NaN padded) by weighted least squares. Ranges are
+    searched over range_fracs of each curve's largest lag while nugget and
+    sills are solved linearly for every curve and candidate at once."""
+    valid = ~np.isnan(semivariance) & ~np.isnan(lags) & (weights > 0)
+    weights = np.where(valid, weights, 0.0)
+    semivariance = np.where(valid, semivariance, 0.0)
+    lags = np.where(valid, lags, 0.0)
+    max_lag = np.where(valid, lags, 0.0).max(axis=1)
+    
+    fracs = np.stack([
+        grid.ravel() for grid 
+        in np.meshgrid(*[range_fracs]*len(structures), indexing='ij')
+        ], axis=-1)
+    ranges = max_lag[:,None,None] * fracs[None]
+    
+    design = [
+        VARIOGRAM_MODELS[structure](lags[:,None,:], ranges[:,:,k,None])
+        for k, structure in enumerate(structures)
+        ]
+    if fit_nugget:
+        design.insert(0, np.ones_like(design[0]))
+    
+    coef, wsse = batch_wls(
+        np.stack(design, axis=-1), semivariance[:,None,:], weights[:,None,:]
+        )
+    best = np.argmin(wsse, axis=1)
+    curves = np.arange(len(lags))
+    coef = coef[curves, best]
+    ranges = ranges[curves, best]
+    wsse = wsse[curves, best]
+    
+    if not fit_nugget:
+        coef = np.column_stack([np.zeros(len(coef)), coef])
+    # NaN models for curves without a non-negative fit
+    coef[np.isinf(wsse)] = np.nan
+    ranges[np.isinf(wsse)] = np.nan
+    return coef[:,0], coef[:,1:], ranges, wsse
+
+def row_block_pairs(start, stop, x, y, max_dist, epsilon):
+    """Pair geometry for a row block in the same sense as the lags table
+    (x_dist = x_1 - x_2), limited to epsilon < xy_dist <= max_dist"""
+    pt_1, pt_2 = condensed_row_pairs(start, stop, len(x))
+    x_dist = x[pt_1] - x[pt_2]
+    y_dist = y[pt_1] - y[pt_2]
+    xy_dist = np.hypot(x_dist, y_dist)
+    keep = (xy_dist <= max_dist) & (xy_dist > epsilon)
+    return {
+        'pt_1': pt_1[keep], 'pt_2': pt_2[keep], 'xy_dist': xy_dist[keep],
+        'x_dist': x_dist[keep], 'y_dist': y_dist[keep]
+        }
+
+def make_lag_bins(lag_min, lag_max, n_lags):
+    return np.linspace(lag_min, lag_max, n_lags+2)[1:-1]
+
+def nearest_bin(vals, centres, tolerance, shift=0):
+    """Index of the (shifted) nearest of the evenly spaced bin centres if
+    vals lie within tolerance of it, otherwise -1. A 2D array of centres
+    (class x bin) gives one row of indices per class."""
+    single = np.ndim(centres) == 1
+    centres = np.atleast_2d(centres)
+    n_bins = centres.shape[1]
+    spacing = centres[:,1:2] - centres[:,:1] if n_bins > 1 else 1.0
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        idx = np.rint((vals - centres[:,:1]) / spacing)
+    idx = np.nan_to_num(idx, nan=-1, posinf=-1, neginf=-1).astype(np.int64)
+    idx += shift
+    
+    inside = (idx >= 0) & (idx < n_bins)
+    idx[~inside] = 0
+    centre = np.take_along_axis(centres, idx, axis=1)
+    tolerance = np.reshape(tolerance, (-1, 1))
+    # the inclusive window arithmetic of the lags table methods
+    inside &= (vals >= centre - tolerance) & (vals <= centre + tolerance)
+    idx = np.where(inside, idx, -1)
+    return idx[0] if single else idx
+
+def azimuth_classes(pairs, azimuths_ccw_ew_rad, azi_tol_rad, 
+                    bandwidth_tolerance):
+    """Membership (azimuth class x pair) of pairs under the azimuth and 
+    bandwidth filter of Variogram.filter_lags_azimuth, broadcast over all 
+    classes at once. The projections keep the filter's arithmetic so a 
+    pair and its reverse (-h) always fall in the same classes."""
+    cos_azi = np.cos(np.reshape(azimuths_ccw_ew_rad, (-1, 1)))
+    sin_azi = np.sin(np.reshape(azimuths_ccw_ew_rad, (-1, 1)))
+    azimuth_dist = (
+        pairs['x_dist'] * cos_azi + pairs['y_dist'] * sin_azi
+        ) / pairs['xy_dist']
+    bandwidth_dist = cos_azi * pairs['y_dist'] - sin_azi * pairs['x_dist']
+    return (
+        (abs(azimuth_dist) <= np.reshape(azi_tol_rad, (-1, 1)))
+        & (abs(bandwidth_dist) <= np.reshape(bandwidth_tolerance, (-1, 1)))
+        )
+
+ROBUST_ESTIMATORS = ('cressie_hawkins', 'madogram', 'pairwise_relative')
+
+def pair_statistic(estimator, vals_1, vals_2, a, b):
+    """Per-pair term summed into the lag bins for an estimator of value
+    columns a and b: the difference product (classical), root absolute
+    difference (cressie_hawkins), absolute difference (madogram) or 
+    squared difference over the squared pair mean (pairwise_relative)"""
+    val_diff = vals_1[:,a] - vals_2[:,a]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if estimator == 'cressie_hawkins':
+            stat = np.sqrt(np.abs(val_diff))
+        elif estimator == 'madogram':
+            stat = np.abs(val_diff)
+        elif estimator == 'pairwise_relative':
+            stat = val_diff**2 / ((vals_1[:,a] + vals_2[:,a])/2)**2
+        else:
+            stat = val_diff * (vals_1[:,b] - vals_2[:,b])
+    # pandas sums skip NaN differences but still count the pair
+    return np.nan_to_num(stat, nan=0.0, posinf=0.0, neginf=0.0)
+
+def estimator_semivariance(estimator, counts, sums):
+    """Semivariance from binned pair counts and estimator sums, with the 
+    Cressie-Hawkins bias correction for cressie_hawkins"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if estimator == 'cressie_hawkins':
+            semivariance = (sums/counts)**4 / (2*(0.457 + 0.494/counts))
+        else:
+            semivariance = sums / (2*counts)
+    return np.where(counts > 0, semivariance, np.nan)
+
+def semivariance_frame(counts, sums, estimator_sums=None, orders=2):
+    """Semivariance and pair counts from binned condensed sums, with a
+    semivariance_<estimator> column for each of estimator_sums. Pairs are
+    stored once (i < j) but counted in both orders like the lags table,
+    unless orders=1 for maps, whose cells hold each order separately"""
+    variogram = pd.DataFrame({
+        'semivariance': estimator_semivariance('classical', counts, sums), 
+        'n_pairs': np.rint(orders*counts).astype(np.int64)
+        })
+    if estimator_sums is not None:
+        for estimator, est_sums in estimator_sums.items():
+            variogram['semivariance_' + estimator] = estimator_semivariance(
+                estimator, counts, est_sums
+                )
+    return variogram
+
+def fft_variogram_sums(grid, mask):
+    """Pair counts and squared difference sums for every lag vector of a
+    masked grid from FFT cross-correlations (Marcotte, 1996). Outputs are
+    centred on the zero lag with y lags along rows and x lags along 
+    columns, and hold each pair at both +h and -h."""
+    n_y, n_x = grid.shape
+    shape = (sfft.next_fast_len(2*n_y - 1), sfft.next_fast_len(2*n_x - 1))
+    mask = mask.astype(float)
+    grid = np.where(mask > 0, grid, 0.0)
+    
+    fft_mask = sfft.rfft2(mask, shape)
+    fft_grid = sfft.rfft2(grid, shape)
+    fft_sq_grid = sfft.rfft2(grid**2, shape)
+    
+    counts = sfft.irfft2(np.conj(fft_mask) * fft_mask, shape)
+    sums = sfft.irfft2(
+        np.conj(fft_mask) * fft_sq_grid + np.conj(fft_sq_grid) * fft_mask
+        - 2 * np.conj(fft_grid) * fft_grid, shape
+        )
+    
+    def centre(arr):
+        arr = np.concatenate([arr[shape[0] - n_y + 1:], arr[:n_y]], axis=0)
+        return np.concatenate([arr[:,shape[1] - n_x + 1:], arr[:,:n_x]], axis=1)
+    
+    counts = np.rint(centre(counts))
+    sums = np.where(counts > 0, np.clip(centre(sums), 0, None), 0.0)
+    return counts, sums
+
+def load_pair_cache(cache_dir):
+    """Memory-map a pair table written by Variogram.build_pair_cache"""
+    cache_dir = Path(cache_dir)
+    with open(cache_dir / 'pair_cache.json') as f:
+        meta = json.load(f)
+    
+    cache = {'row_offsets': np.load(cache_dir / 'row_offsets.npy')}
+    for col in PAIR_COLUMNS:
+        if meta['n_pairs'] == 0:
+            cache[col] = np.zeros(0, dtype=meta['dtypes'][col])
+        else:
+            cache[col] = np.memmap(
+                cache_dir / (col + '.bin'), dtype=meta['dtypes'][col], 
+                mode='r', shape=(meta['n_pairs'],)
+                )
+    return cache
+
+_block_data = {}
+
+def _init_block_worker(data):
+    _block_data.clear()
+    _block_data.update(data)
+    if data.get('pair_cache_dir') is not None:
+        _block_data['pair_cache'] = load_pair_cache(data['pair_cache_dir'])
+
+def _block_pairs_and_classes(start, stop, kind, settings):
+    if 'pair_cache' in _block_data:
+        cache = _block_data['pair_cache']
+        first, last = cache['row_offsets'][start], cache['row_offsets'][stop]
+        pairs = {col: np.asarray(cache[col][first:last]) for col in PAIR_COLUMNS}
+    else:
+        pairs = row_block_pairs(
+            start, stop, _block_data['x'], _block_data['y'],
+            settings['max_dist'], settings['epsilon']
+            )
+    if kind == 'azi':
+        classes = azimuth_classes(
+            pairs, settings['azimuths_ccw_ew_rad'], settings['azi_tol_rad'],
+            settings['bandwidth_tolerance']
+            )
+    else:
+        classes = np.ones((1, len(pairs['xy_dist'])), dtype=bool)
+    return pairs, classes
+
+def class_extents(pairs, classes, cols):
+    """Min and max of each column over the pairs in each class (NaN for 
+    empty classes)"""
+    extents = np.full((len(classes), 2*len(cols)), np.nan)
+    
+    if len(pairs['xy_dist']) > 0:
+        for k, col in enumerate(cols):
+            extents[:,2*k] = np.where(classes, pairs[col], np.inf).min(axis=1)
+            extents[:,2*k+1] = np.where(classes, pairs[col], -np.inf).max(axis=1)
+    
+    extents[np.isinf(extents)] = np.nan
+    return extents
+
+def lag_class_index(pairs, classes, bins, shift=0):
+    """Flattened (class, lag bin) index of each pair in each class, or -1
+    outside the class or the lag bins. With shift=-1 or 1 the index is of
+    the neighbour of the nearest bin, which only holds pairs exactly on 
+    the edge between them, as the inclusive windows of the lags table 
+    count those pairs in both bins."""
+    lag_idx = nearest_bin(
+        pairs['xy_dist'], bins['lag_bins'], bins['lag_tolerance'], shift
+        )
+    class_offset = np.arange(len(classes))[:,None] * bins['lag_bins'].shape[1]
+    return np.where(
+        classes & (lag_idx >= 0), class_offset + lag_idx, -1
+        ).ravel()
+
+def block_extents(task):
+    """Lag extents per class (or x and y lag extents for maps) of the 
+    pairs in a row block"""
+    pairs, classes = _block_pairs_and_classes(*task)
+    if task[2] != 'map':
+        return class_extents(pairs, classes, ['xy_dist'])
+    
+    # maps hold each pair at both +h and -h
+    extents = class_extents(pairs, classes, ['x_dist', 'y_dist'])
+    mirrored = -extents[:,[1, 0, 3, 2]]
+    extents[:,0::2] = np.fmin(extents[:,0::2], mirrored[:,0::2])
+    extents[:,1::2] = np.fmax(extents[:,1::2], mirrored[:,1::2])
+    return extents
+
+def block_sums(task):
+    """Binned estimator sums and pair counts of a row block. Each (a, b,
+    estimator) in settings['statistics'] sums pair_statistic over the
+    value columns, so classical with a = b gives the squared differences 
+    of a variogram and a != b a cross-variogram."""
+    start, stop, kind, settings, bins = task
+    pairs, classes = _block_pairs_and_classes(start, stop, kind, settings)
+    vals_1 = _block_data['vals'][pairs['pt_1']]
+    vals_2 = _block_data['vals'][pairs['pt_2']]
+    products = [
+        pair_statistic(estimator, vals_1, vals_2, a, b)
+        for a, b, estimator in settings['statistics']
+        ]
+    
+    n_cells = bins['n_bins']
+    if kind == 'map':
+        n_y = len(bins['y_lags'])
+        # map windows overlap, so a pair may also fall in a neighbour, and
+        # each pair is binned at both +h and -h like the lags table
+        idx = []
+        for sign in (1, -1):
+            x_idx = [
+                nearest_bin(sign*pairs['x_dist'], bins['x_lags'], bins['x_tol'], shift)
+                for shift in (-1, 0, 1)
+                ]
+            y_idx = [
+                nearest_bin(sign*pairs['y_dist'], bins['y_lags'], bins['y_tol'], shift)
+                for shift in (-1, 0, 1)
+                ]
+            idx += [np.where((ix >= 0) & (iy >= 0), ix*n_y + iy, -1)
+                    for ix in x_idx for iy in y_idx]
+    else:
+        idx = [
+            lag_class_index(pairs, classes, bins, shift) 
+            for shift in (-1, 0, 1)
+            ]
+        products = [
+            np.broadcast_to(product, classes.shape).ravel() 
+            for product in products
+            ]
+        
+        if _block_data.get('groups') is not None:
+            # split each lag bin by the spatial groups of both points
+            n_groups = settings['n_groups']
+            group_pair = (
+                _block_data['groups'][pairs['pt_1']] * n_groups 
+                + _block_data['groups'][pairs['pt_2']]
+                )
+            group_pair = np.broadcast_to(group_pair, classes.shape).ravel()
+            idx = [np.where(
+                bin_idx >= 0, bin_idx * n_groups**2 + group_pair, -1
+                ) for bin_idx in idx]
+            n_cells = bins['n_bins'] * n_groups**2
+    
+    counts = np.zeros(n_cells)
+    sums = np.zeros((len(products), n_cells))
+    for bin_idx in idx:
+        keep = bin_idx >= 0
+        counts += np.bincount(bin_idx[keep], minlength=n_cells)
+        for k, product in enumerate(products):
+            sums[k] += np.bincount(
+                bin_idx[keep], weights=product[keep], minlength=n_cells
+                )
+    return counts, sums
+
 class Variogram(object):
     """A class to analyze and model experimental variograms of a 
     GeostatsDataFrame object. Based on GSLIB (Deutsch and
@@ -27,11 +445,25 @@ class Variogram(object):
     save_figures = True
     show_figures = True
     output_path = './output/'
+    n_jobs = 1
+    block_pairs = 1000000
+    pair_cache = False
+    random_seed = 73073
+    estimators = ('classical',)
     
-    def __init__(self, geostats_df, val_col_str):
+    def __init__(self, geostats_df, val_col_str, weight_col_str = None):
+        """weight_col_str names declustering weights (e.g. declus_weight
+        from GeostatsDataFrame.declus) for the sill variance"""
         self.gs_df = geostats_df
         self.val_col = val_col_str
         self.val_col_var = self.gs_df.loc[:,self.val_col].std()**2
+        if weight_col_str is not None:
+            valid = self.gs_df[[self.val_col, weight_col_str]].notna().all(axis=1)
+            vals = self.gs_df.loc[valid, self.val_col].to_numpy(dtype=float)
+            weights = self.gs_df.loc[valid, weight_col_str].to_numpy(dtype=float)
+            mean = np.average(vals, weights=weights)
+            self.val_col_var = (np.average((vals - mean)**2, weights=weights)
+                                * len(vals) / (len(vals) - 1))
         self.n_lags = round(self.gs_df.shape[0]/10)
         self.max_dist = max(self.gs_df.x.max(), self.gs_df.y.max())
         self.bandwidth_tolerance = self.max_dist/2
@@ -71,8 +503,9 @@ class Variogram(object):
         
     def calculate_lags(self):
         h = ssd.squareform(ssd.pdist(self.gs_df[['x','y']])).flatten()
-        x = ssd.squareform(ssd.pdist(self.gs_df[['x']], lambda u,v : u-v)).flatten()
-        y = ssd.squareform(ssd.pdist(self.gs_df[['y']], lambda u,v : u-v)).flatten()
+        # x_dist of (j, i) is minus that of (i, j), so maps hold both signs
+        x = np.subtract.outer(self.gs_df.x.to_numpy(), self.gs_df.x.to_numpy()).flatten()
+        y = np.subtract.outer(self.gs_df.y.to_numpy(), self.gs_df.y.to_numpy()).flatten()
         self.lags = pd.DataFrame({'xy_dist': h, 'x_dist': x, 'y_dist': y})
 
     def map_values_to_lags(self):
@@ -101,11 +534,11 @@ class Variogram(object):
         self.lags = self.lags[self.lags.xy_dist > self.epsilon]
         
     def bin_lags(self):
-        self.lag_bins = np.linspace(
+        self.lag_bins = make_lag_bins(
                 self.lags.xy_dist.min(), 
                 self.lags.xy_dist.max(), 
-                self.n_lags+2
-                )[1:-1]
+                self.n_lags
+                )
     
     def calculate_azimuth(self):
         self.lags['azimuth_dist'] = (
@@ -142,20 +575,200 @@ class Variogram(object):
         
         return semivariance, n_pairs
     
-    def calc_omni_variogram(self):
-        self.lags = self.lags_orig.copy()
-        self.bin_lags()
-        self.set_default_lag_tolerance()
+    def accumulate_row_blocks(self, kind, settings, vals=None, 
+                              products=((0, 0),), groups=None):
+        """Accumulate binned sums and counts over row blocks of the pair
+        matrix without building the lags table, in a process pool when
+        n_jobs > 1. Blocks do not depend on n_jobs and partial results are
+        reduced in block order, so results are reproducible. vals defaults 
+        to val_col and products to its squared differences. With pair_cache
+        set, blocks are read from the memory-mapped pair table. Sums are
+        keyed by (a, b, estimator), with the robust estimators computed
+        for a = b only. Given integer point groups (not for maps), counts 
+        and sums are further split by the groups of both pair points.
+        Lag bins need the extents of all blocks first, so every block is 
+        visited twice (extents, then sums) and its pair geometry and 
+        azimuth classes are computed in both visits rather than held for
+        the whole pair matrix."""
+        if vals is None:
+            vals = self.gs_df[[self.val_col]]
+        
+        statistics = [(a, b, 'classical') for a, b in products] + [
+            (a, b, estimator) for a, b in products 
+            for estimator in self.estimators 
+            if estimator != 'classical' and a == b
+            ]
         
-        self.omni_variogram = pd.DataFrame([
-                self.calc_lag_semivariance(lag_bin) 
-                for lag_bin 
-                in self.lag_bins
-                ], columns = ('semivariance', 'n_pairs'))
+        data = {
+            'x': self.gs_df.x.to_numpy(dtype=float),
+            'y': self.gs_df.y.to_numpy(dtype=float),
+            'vals': np.asarray(vals, dtype=float),
+            'groups': None if groups is None else np.asarray(groups),
+            'pair_cache_dir': 
+                str(self.build_pair_cache()) if self.pair_cache else None
+            }
+        n_groups = 1 if groups is None else int(np.max(groups)) + 1
+        settings = dict(
+            settings, max_dist=self.max_dist, epsilon=self.epsilon, 
+            statistics=statistics, n_groups=n_groups
+            )
+        tasks = [
+            (start, stop, kind, settings) 
+            for start, stop 
+            in split_row_blocks(len(self.gs_df), self.block_pairs)
+            ]
+        
+        if self.n_jobs > 1:
+            pool = ProcessPoolExecutor(
+                self.n_jobs, initializer=_init_block_worker, initargs=(data,)
+                )
+            map_blocks = pool.map
+        else:
+            pool = None
+            _init_block_worker(data)
+            map_blocks = map
+        
+        try:
+            extents = np.array(list(map_blocks(block_extents, tasks)))
+            bins = self.bin_row_blocks(
+                kind, np.fmin.reduce(extents), np.fmax.reduce(extents)
+                )
+            partials = map_blocks(
+                block_sums, [task + (bins,) for task in tasks]
+                )
+            n_cells = bins['n_bins'] * (1 if groups is None else n_groups**2)
+            counts = np.zeros(n_cells)
+            sums = np.zeros((len(statistics), n_cells))
+            for partial_counts, partial_sums in partials:
+                counts += partial_counts
+                sums += partial_sums
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        
+        return counts, dict(zip(statistics, sums)), bins
+    
+    def variogram_frame(self, counts, sums, a=0, b=0, orders=2):
+        """Semivariance frame of value columns a and b from row-block sums,
+        with a column for each robust estimator in estimators"""
+        return semivariance_frame(counts, sums[(a, b, 'classical')], {
+            estimator: sums[(a, b, estimator)] 
+            for estimator in self.estimators 
+            if (a, b, estimator) in sums and estimator != 'classical'
+            }, orders)
+    
+    def use_row_blocks(self):
+        """Whether the variogram methods skip the lags table, which only
+        holds classical squared differences"""
+        return (
+            self.n_jobs > 1 or self.pair_cache 
+            or any(estimator != 'classical' for estimator in self.estimators)
+            )
+    
+    def pair_cache_key(self):
+        """Hash of the coordinates and distance limits of the pair table"""
+        digest = hashlib.sha1()
+        for coord in ('x', 'y'):
+            digest.update(self.gs_df[coord].to_numpy(dtype=float).tobytes())
+        digest.update(np.array([self.max_dist, self.epsilon], dtype=float).tobytes())
+        return digest.hexdigest()
+    
+    def build_pair_cache(self):
+        """Write the condensed pair geometry (indices, distances, x and y 
+        lags) within max_dist as memory-mappable arrays under output_path,
+        unless the same coordinates and max_dist are already cached. The 
+        cache does not depend on values, lag bins or azimuths."""
+        cache_dir = Path(self.output_path) / 'pair_cache' / self.pair_cache_key()
+        if (cache_dir / 'pair_cache.json').exists():
+            print('Using cached pair table ' + str(cache_dir))
+            return cache_dir
+        
+        print('Caching pair table ' + str(cache_dir))
+        tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        
+        n = len(self.gs_df)
+        x = self.gs_df.x.to_numpy(dtype=float)
+        y = self.gs_df.y.to_numpy(dtype=float)
+        idx_dtype = np.int32 if n < 2**31 else np.int64
+        dtypes = {
+            col: idx_dtype if col in ('pt_1', 'pt_2') else np.float64 
+            for col in PAIR_COLUMNS
+            }
+        row_counts = np.zeros(n, dtype=np.int64)
+        
+        files = {col: open(tmp_dir / (col + '.bin'), 'wb') for col in PAIR_COLUMNS}
+        try:
+            for start, stop in split_row_blocks(n, self.block_pairs):
+                pairs = row_block_pairs(
+                    start, stop, x, y, self.max_dist, self.epsilon
+                    )
+                row_counts[start:stop] = np.bincount(
+                    pairs['pt_1'] - start, minlength=stop - start
+                    )
+                for col in PAIR_COLUMNS:
+                    pairs[col].astype(dtypes[col]).tofile(files[col])
+        finally:
+            for f in files.values():
+                f.close()
+        
+        np.save(tmp_dir / 'row_offsets.npy', np.concatenate([[0], np.cumsum(row_counts)]))
+        with open(tmp_dir / 'pair_cache.json', 'w') as f:
+            json.dump({
+                'n_points': n, 'n_pairs': int(row_counts.sum()),
+                'max_dist': float(self.max_dist), 'epsilon': self.epsilon,
+                'dtypes': {col: np.dtype(dtype).name for col, dtype in dtypes.items()}
+                }, f)
+        
+        tmp_dir.replace(cache_dir)
+        return cache_dir
+    
+    def bin_row_blocks(self, kind, extent_min, extent_max):
+        """Lag bins per class (or map lags) from the reduced block extents"""
+        if kind == 'map':
+            x_lags = make_lag_bins(extent_min[0,0], extent_max[0,1], self.n_lags)
+            y_lags = make_lag_bins(extent_min[0,2], extent_max[0,3], self.n_lags)
+            self.map_xx, self.map_yy = np.meshgrid(x_lags, y_lags, sparse = True)
+            self.set_map_lag_tolerance()
+            return {
+                'x_lags': x_lags, 'y_lags': y_lags, 'x_tol': self.map_lag_x_tol,
+                'y_tol': self.map_lag_y_tol, 'n_bins': len(x_lags)*len(y_lags)
+                }
+        
+        lag_bins = np.array([
+            make_lag_bins(lag_min, lag_max, self.n_lags)
+            for lag_min, lag_max in zip(extent_min[:,0], extent_max[:,1])
+            ])
+        return {
+            'lag_bins': lag_bins, 
+            'lag_tolerance': np.diff(lag_bins, axis=1).min(axis=1)/2,
+            'n_bins': lag_bins.size
+            }
+    
+    def calc_omni_variogram(self):
+        if self.use_row_blocks():
+            counts, sums, bins = self.accumulate_row_blocks('omni', {})
+            self.omni_variogram = self.variogram_frame(counts, sums)
+            self.lag_bins = bins['lag_bins'][0]
+            self.lag_tolerance = bins['lag_tolerance'][0]
+        else:
+            self.lags = self.lags_orig.copy()
+            self.bin_lags()
+            self.set_default_lag_tolerance()
+            
+            self.omni_variogram = pd.DataFrame([
+                    self.calc_lag_semivariance(lag_bin) 
+                    for lag_bin 
+                    in self.lag_bins
+                    ], columns = ('semivariance', 'n_pairs'))
         
         if self.standardize_sill:
-            self.omni_variogram['semivariance'] = (
-               self.omni_variogram['semivariance']
+            cols = [
+                col for col in self.omni_variogram.columns 
+                if col.startswith('semivariance')
+                ]
+            self.omni_variogram[cols] = (
+               self.omni_variogram[cols]
                /self.val_col_var
                )
 
@@ -163,23 +776,178 @@ class Variogram(object):
 
     def write_omni_variogram(self):
         self.omni_variogram.to_csv(self.output_path+'omni_variogram.csv')
+    
+    def spatial_blocks(self, block_size=None):
+        """Integer id of the square spatial block containing each point, 
+        numbering occupied blocks only. block_size defaults to a fifth of 
+        the larger coordinate extent."""
+        if block_size is None:
+            block_size = max(self.gs_df.x.max(), self.gs_df.y.max())/5
+        cells = np.column_stack([
+            np.floor(self.gs_df[coord].to_numpy(dtype=float)/block_size)
+            for coord in ('x', 'y')
+            ]).astype(np.int64)
+        return np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+    
+    def calc_variogram_uncertainty(self, block_size=None, n_boot=1000, 
+                                   ci=0.95):
+        """Spatial block bootstrap and leave-one-block-out jackknife 
+        confidence intervals for the omnidirectional variogram. One pass
+        over the pairs splits each lag bin's sums by the blocks of both 
+        points; each replicate is then a reweighting of those sums by 
+        block multiplicities, so replicates never revisit the pairs."""
+        rng = np.random.default_rng(self.random_seed)
+        blocks = self.spatial_blocks(block_size)
+        n_blocks = blocks.max() + 1
+        
+        counts, sums, bins = self.accumulate_row_blocks(
+            'omni', {}, groups=blocks
+            )
+        shape = (self.n_lags, n_blocks, n_blocks)
+        counts = counts.reshape(shape)
+        sums = sums[(0, 0, 'classical')].reshape(shape)
+        
+        def replicate(weights):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return (
+                    np.einsum('ra,kab,rb->rk', weights, sums, weights)
+                    / (2*np.einsum('ra,kab,rb->rk', weights, counts, weights))
+                    )
+        
+        boot = replicate(rng.multinomial(
+            n_blocks, np.full(n_blocks, 1/n_blocks), size=n_boot
+            ).astype(float))
+        jack = replicate(1.0 - np.eye(n_blocks))
+        jack_se = np.sqrt(
+            (n_blocks - 1)/n_blocks 
+            * np.nansum((jack - np.nanmean(jack, axis=0))**2, axis=0)
+            )
+        
+        uncertainty = semivariance_frame(counts.sum(axis=(1, 2)), sums.sum(axis=(1, 2)))
+        uncertainty['boot_lower'] = np.nanquantile(boot, (1 - ci)/2, axis=0)
+        uncertainty['boot_upper'] = np.nanquantile(boot, (1 + ci)/2, axis=0)
+        uncertainty['jackknife_se'] = jack_se
+        z = norm.ppf((1 + ci)/2)
+        uncertainty['jackknife_lower'] = uncertainty['semivariance'] - z*jack_se
+        uncertainty['jackknife_upper'] = uncertainty['semivariance'] + z*jack_se
+        
+        if self.standardize_sill:
+            cols = [col for col in uncertainty.columns if col != 'n_pairs']
+            uncertainty[cols] = uncertainty[cols]/self.val_col_var
+        
+        uncertainty['lag_bin'] = bins['lag_bins'][0]
+        self.variogram_uncertainty = uncertainty
+    
+    def write_variogram_uncertainty(self):
+        self.variogram_uncertainty.to_csv(
+            self.output_path+'variogram_uncertainty.csv'
+            )
+    
+    def calc_sampled_variogram(self, target_pairs=1000, n_boot=200, ci=0.95,
+                               max_draws=10000000):
+        """Quick-look omnidirectional variogram from randomly drawn pairs,
+        keeping up to target_pairs per lag bin, with percentile bootstrap
+        confidence intervals. Lag bins come from the sampled pair extents
+        so they approximate those of calc_omni_variogram."""
+        rng = np.random.default_rng(self.random_seed)
+        n = len(self.gs_df)
+        x = self.gs_df.x.to_numpy(dtype=float)
+        y = self.gs_df.y.to_numpy(dtype=float)
+        vals = self.gs_df[self.val_col].to_numpy(dtype=float)
+        batch = max(100000, 4*target_pairs*self.n_lags)
+        
+        bin_idx = []
+        sq_val_diff = []
+        counts = np.zeros(self.n_lags)
+        draws = 0
+        while draws < max_draws and counts.min() < target_pairs:
+            pt_1 = rng.integers(0, n, batch)
+            pt_2 = rng.integers(0, n, batch)
+            draws += batch
+            xy_dist = np.hypot(x[pt_1] - x[pt_2], y[pt_1] - y[pt_2])
+            keep = (xy_dist <= self.max_dist) & (xy_dist > self.epsilon)
+            
+            if draws == batch:
+                self.sampled_lag_bins = make_lag_bins(
+                    xy_dist[keep].min(), xy_dist[keep].max(), self.n_lags
+                    )
+                lag_tolerance = np.diff(self.sampled_lag_bins).min()/2
+            
+            idx = nearest_bin(xy_dist, self.sampled_lag_bins, lag_tolerance)
+            keep &= idx >= 0
+            bin_idx.append(idx[keep])
+            # pandas sums skip NaN differences but still count the pair
+            sq_val_diff.append(np.nan_to_num(
+                (vals[pt_1[keep]] - vals[pt_2[keep]])**2
+                ))
+            counts += np.bincount(idx[keep], minlength=self.n_lags)
+        
+        bin_idx = np.concatenate(bin_idx)
+        sq_val_diff = np.concatenate(sq_val_diff)
+        order = np.argsort(bin_idx, kind='stable')
+        bin_idx = bin_idx[order]
+        sq_val_diff = sq_val_diff[order]
+        first = np.searchsorted(bin_idx, np.arange(self.n_lags))
+        keep = np.arange(len(bin_idx)) - first[bin_idx] < target_pairs
+        bin_idx = bin_idx[keep]
+        sq_val_diff = sq_val_diff[keep]
+        
+        counts = np.bincount(bin_idx, minlength=self.n_lags)
+        # each draw is one ordered pair
+        sampled_variogram = semivariance_frame(
+            counts, np.bincount(bin_idx, sq_val_diff, self.n_lags), orders=1
+            )
+        
+        bounds = np.full((self.n_lags, 2), np.nan)
+        for k, bin_sq in enumerate(np.split(sq_val_diff, np.cumsum(counts)[:-1])):
+            if len(bin_sq) == 0:
+                continue
+            boot = bin_sq[rng.integers(0, len(bin_sq), (n_boot, len(bin_sq)))]
+            bounds[k] = np.quantile(
+                boot.mean(axis=1)/2, [(1 - ci)/2, (1 + ci)/2]
+                )
+        
+        sampled_variogram['semivariance_lower'] = bounds[:,0]
+        sampled_variogram['semivariance_upper'] = bounds[:,1]
+        
+        if self.standardize_sill:
+            for col in ('semivariance', 'semivariance_lower', 'semivariance_upper'):
+                sampled_variogram[col] = sampled_variogram[col]/self.val_col_var
+        
+        sampled_variogram['lag_bin'] = self.sampled_lag_bins
+        self.sampled_variogram = sampled_variogram
+        
+        print('Sampled ' + str(len(bin_idx)) + ' of ' + str(draws) + ' drawn pairs')
         
     def calc_azi_variogram(self):
-        self.lags = self.lags_orig.copy()
         self.convert_azimuth()
-        self.calculate_azimuth()
-        self.filter_lags_azimuth()
-        self.bin_lags()
-        self.set_default_lag_tolerance()
         
-        azi_variogram = pd.DataFrame([
-                self.calc_lag_semivariance(lag_bin) 
-                for lag_bin 
-                in self.lag_bins
-                ], columns = ('semivariance', 'n_pairs'))
+        if self.use_row_blocks():
+            counts, sums, bins = self.accumulate_row_blocks(
+                'azi', self.azimuth_settings([self.azimuth_cw_from_ns_deg])
+                )
+            azi_variogram = self.variogram_frame(counts, sums)
+            self.lag_bins = bins['lag_bins'][0]
+            self.lag_tolerance = bins['lag_tolerance'][0]
+        else:
+            self.lags = self.lags_orig.copy()
+            self.calculate_azimuth()
+            self.filter_lags_azimuth()
+            self.bin_lags()
+            self.set_default_lag_tolerance()
+            
+            azi_variogram = pd.DataFrame([
+                    self.calc_lag_semivariance(lag_bin) 
+                    for lag_bin 
+                    in self.lag_bins
+                    ], columns = ('semivariance', 'n_pairs'))
         
         if self.standardize_sill:
-           azi_variogram = azi_variogram/self.val_col_var
+            cols = [
+                col for col in azi_variogram.columns 
+                if col.startswith('semivariance')
+                ]
+            azi_variogram[cols] = azi_variogram[cols]/self.val_col_var
 
         azi_variogram['lag_bin'] = self.lag_bins
         azi_variogram['azimuth'] = self.azimuth_cw_from_ns_deg
@@ -191,10 +959,248 @@ class Variogram(object):
         else:
             self.azi_variogram = azi_variogram
     
+    def experimental_curves(self):
+        """Each experimental curve in omni_variogram, azi_variogram and 
+        multi_variogram with its source, variable and azimuth"""
+        curves = []
+        for source in ('omni_variogram', 'azi_variogram', 'multi_variogram'):
+            if not hasattr(self, source):
+                continue
+            frame = getattr(self, source)
+            keys = [col for col in ('variable', 'azimuth') if col in frame]
+            groups = frame.groupby(keys, sort=False) if keys else [((), frame)]
+            
+            for key, curve in groups:
+                key = dict(zip(keys, key if isinstance(key, tuple) else (key,)))
+                curves.append(({
+                    'source': source, 
+                    'variable': key.get('variable', self.val_col),
+                    'azimuth': key.get('azimuth', np.nan)
+                    }, curve))
+        return curves
+    
+    def fit_variogram_models(self, structures=('spherical',), n_ranges=30,
+                             fit_nugget=True):
+        """Fit a nugget plus nested structures (spherical, exponential or 
+        gaussian) to every experimental curve as one vectorized batch,
+        weighted by n_pairs. Results go to variogram_models with one row 
+        per curve."""
+        curves = self.experimental_curves()
+        n_lags = max(len(curve) for _, curve in curves)
+        
+        def padded(col):
+            return np.array([
+                np.pad(curve[col].to_numpy(dtype=float), 
+                       (0, n_lags - len(curve)), constant_values=np.nan)
+                for _, curve in curves
+                ])
+        
+        nugget, sills, ranges, wsse = fit_nested_models(
+            padded('lag_bin'), padded('semivariance'), padded('n_pairs'),
+            structures, np.linspace(0, 1.5, n_ranges + 1)[1:], fit_nugget
+            )
+        
+        variogram_models = pd.DataFrame([record for record, _ in curves])
+        variogram_models['structures'] = '+'.join(structures)
+        variogram_models['nugget'] = nugget
+        for k in range(len(structures)):
+            variogram_models['sill_' + str(k+1)] = sills[:,k]
+            variogram_models['range_' + str(k+1)] = ranges[:,k]
+        variogram_models['wsse'] = wsse
+        self.variogram_models = variogram_models
+        
+        print('Fitted ' + str(len(curves)) + ' variogram models')
+    
+    def write_variogram_models(self):
+        self.variogram_models.to_csv(self.output_path+'variogram_models.csv')
+    
+    def fit_anisotropy_model(self, structure='spherical', n_ranges=30, 
+                             n_ratios=20, azimuth_step_deg=5, fit_nugget=True):
+        """Fit a geometric anisotropy model jointly to all azimuths of the
+        azimuthal curves (per source and variable): one nugget and sill with a range 
+        ellipse given by major_range, minor_range and major_azimuth (cw 
+        from NS). The ellipse is searched on a grid and the nugget and sill
+        solved linearly for every candidate at once."""
+        records = []
+        curves = [
+            (record, curve) for record, curve in self.experimental_curves() 
+            if not pd.isna(record['azimuth'])
+            ]
+        
+        groups = dict.fromkeys(
+            (record['source'], record['variable']) for record, _ in curves
+            )
+        for source, variable in groups:
+            azi_curves = pd.concat([
+                curve.assign(azimuth=record['azimuth']) 
+                for record, curve in curves 
+                if (record['source'], record['variable']) == (source, variable)
+                ]).dropna(subset=['semivariance'])
+            lags = azi_curves['lag_bin'].to_numpy(dtype=float)
+            azimuths = np.radians(azi_curves['azimuth'].to_numpy(dtype=float))
+            
+            major, ratio, angle = [grid.ravel() for grid in np.meshgrid(
+                lags.max() * np.linspace(0, 1.5, n_ranges + 1)[1:],
+                np.linspace(0, 1, n_ratios + 1)[1:],
+                np.radians(np.arange(0, 180, azimuth_step_deg)),
+                indexing='ij'
+                )]
+            offset = azimuths[None,:] - angle[:,None]
+            range_ = major[:,None] * ratio[:,None] / np.hypot(
+                ratio[:,None]*np.cos(offset), np.sin(offset)
+                )
+            
+            design = [VARIOGRAM_MODELS[structure](lags[None,:], range_)]
+            if fit_nugget:
+                design.insert(0, np.ones_like(design[0]))
+            coef, wsse = batch_wls(
+                np.stack(design, axis=-1), 
+                azi_curves['semivariance'].to_numpy(dtype=float),
+                azi_curves['n_pairs'].to_numpy(dtype=float)
+                )
+            best = np.argmin(wsse)
+            if np.isinf(wsse[best]):
+                # no non-negative fit
+                coef[best] = np.nan
+                major[best] = ratio[best] = angle[best] = np.nan
+            
+            records.append({
+                'source': source, 'variable': variable, 'structure': structure,
+                'nugget': coef[best,0] if fit_nugget else 0.0,
+                'sill': coef[best,-1], 'major_range': major[best],
+                'minor_range': major[best]*ratio[best],
+                'major_azimuth': np.degrees(angle[best]), 'wsse': wsse[best]
+                })
+        
+        self.anisotropy_model = pd.DataFrame(records)
+    
+    def azimuth_settings(self, azimuths, tolerances=None, bandwidths=None):
+        """Azimuth classes for the row-block path, converted the same way as
+        convert_azimuth and convert_azi_tol"""
+        azimuths = np.asarray(azimuths, dtype=float)
+        
+        if tolerances is None:
+            tolerances = self.azimuth_tolerance_deg
+        tolerances = np.broadcast_to(np.asarray(tolerances, dtype=float), azimuths.shape)
+        
+        if bandwidths is None:
+            bandwidths = self.bandwidth_tolerance
+        bandwidths = np.broadcast_to(np.asarray(bandwidths, dtype=float), azimuths.shape)
+        
+        return {
+            'azimuths_ccw_ew_rad': (90.0 - azimuths) * math.pi / 180.0,
+            'azi_tol_rad': np.where(
+                tolerances <= 0.0, math.cos(45.0 * math.pi / 180.0),
+                np.cos(tolerances * math.pi / 180.0)
+                ),
+            'bandwidth_tolerance': bandwidths
+            }
+    
+    def calc_azi_variograms(self, azimuths, tolerances=None, bandwidths=None):
+        """Azimuthal variograms for a list of azimuths, with every azimuth
+        class filled from the same row blocks of pairs (see 
+        accumulate_row_blocks). Tolerances (degrees) and bandwidths may be given per
+        azimuth and default to azimuth_tolerance_deg and bandwidth_tolerance.
+        Replaces azi_variogram with a tidy frame of all azimuths."""
+        counts, sums, bins = self.accumulate_row_blocks(
+            'azi', self.azimuth_settings(azimuths, tolerances, bandwidths)
+            )
+        
+        azi_variogram = self.variogram_frame(counts, sums)
+        
+        if self.standardize_sill:
+            cols = [
+                col for col in azi_variogram.columns 
+                if col.startswith('semivariance')
+                ]
+            azi_variogram[cols] = azi_variogram[cols]/self.val_col_var
+        
+        azi_variogram['lag_bin'] = bins['lag_bins'].ravel()
+        azi_variogram['azimuth'] = np.repeat(azimuths, self.n_lags)
+        self.azi_variogram = azi_variogram
+    
     def write_azi_variogram(self):
         self.azi_variogram.to_csv(self.output_path+'azi_variogram.csv')
     
+    def calc_multi_variograms(self, val_cols, indicator_thresholds=None,
+                              cross_cols=None, azimuths=None):
+        """Variograms of several value columns, their indicator transforms
+        and cross-variograms of column pairs, accumulated over the same
+        row blocks of pairs so each extra variable costs one weighted 
+        bincount per block.
+        indicator_thresholds maps a column to a list of thresholds and 
+        cross_cols is a list of column pairs. Omnidirectional unless 
+        azimuths are given (see calc_azi_variograms)."""
+        vals = pd.DataFrame({col: self.gs_df[col] for col in val_cols})
+        
+        if indicator_thresholds is not None:
+            for col, thresholds in indicator_thresholds.items():
+                for threshold in thresholds:
+                    vals['i_' + col + '_' + str(threshold)] = (
+                        (self.gs_df[col] <= threshold).astype(float)
+                        .where(self.gs_df[col].notna())
+                        )
+        
+        variables = list(vals.columns)
+        products = [(k, k) for k in range(len(variables))]
+        
+        if cross_cols is not None:
+            for col_1, col_2 in cross_cols:
+                for col in (col_1, col_2):
+                    if col not in vals:
+                        vals[col] = self.gs_df[col]
+                products.append(
+                    (vals.columns.get_loc(col_1), vals.columns.get_loc(col_2))
+                    )
+                variables.append(col_1 + ':' + col_2)
+        
+        if azimuths is None:
+            counts, sums, bins = self.accumulate_row_blocks(
+                'omni', {}, vals, products
+                )
+        else:
+            counts, sums, bins = self.accumulate_row_blocks(
+                'azi', self.azimuth_settings(azimuths), vals, products
+                )
+        
+        val_std = vals.std()
+        frames = []
+        for variable, (a, b) in zip(variables, products):
+            variogram = self.variogram_frame(counts, sums, a, b)
+            
+            if self.standardize_sill:
+                cols = [
+                    col for col in variogram.columns 
+                    if col.startswith('semivariance')
+                    ]
+                variogram[cols] = (
+                    variogram[cols]/(val_std.iloc[a]*val_std.iloc[b])
+                    )
+            
+            variogram['lag_bin'] = bins['lag_bins'].ravel()
+            if azimuths is not None:
+                variogram['azimuth'] = np.repeat(azimuths, self.n_lags)
+            variogram.insert(0, 'variable', variable)
+            frames.append(variogram)
+        
+        self.multi_variogram = pd.concat(frames, ignore_index=True)
+    
+    def write_multi_variogram(self):
+        self.multi_variogram.to_csv(self.output_path+'multi_variogram.csv')
+    
     def make_variogram_map(self):
+        if self.use_row_blocks():
+            counts, sums, _ = self.accumulate_row_blocks('map', {})
+            variogram_map = self.variogram_frame(counts, sums, orders=1)
+            variogram_map.insert(
+                0, 'x', np.repeat(self.map_xx[0,:], self.map_yy.shape[0])
+                )
+            variogram_map.insert(
+                1, 'y', np.tile(self.map_yy[:,0], self.map_xx.shape[1])
+                )
+            self.variogram_map = variogram_map.dropna()
+            return
+        
         self.lags = self.lags_orig.copy()
         self.map_bin_lags()
         self.set_map_lag_tolerance()
@@ -206,17 +1212,17 @@ class Variogram(object):
                 ], columns = ('x','y','semivariance', 'n_pairs')).dropna()
                   
     def map_bin_lags(self):
-        x_lags = np.linspace(
+        x_lags = make_lag_bins(
                 self.lags.x_dist.min(), 
                 self.lags.x_dist.max(), 
-                self.n_lags+2
-                )[1:-1]
+                self.n_lags
+                )
         
-        y_lags = np.linspace(
+        y_lags = make_lag_bins(
                 self.lags.y_dist.min(), 
                 self.lags.y_dist.max(), 
-                self.n_lags+2
-                )[1:-1]
+                self.n_lags
+                )
         
         self.map_xx, self.map_yy = np.meshgrid(x_lags, y_lags, sparse = True)
         
@@ -249,6 +1255,133 @@ class Variogram(object):
     def write_variogram_map(self):
         self.variogram_map.to_csv(self.output_path+'variogram_map.csv')
     
+    def grid_values(self, spacing=None, mask=None):
+        """Place the value column on its regular x/y grid, detecting the
+        grid spacing from the coordinates unless given or carried in the
+        frame's attrs (GeostatsDataFrame.from_windows). Cells without a
+        point, with a NaN value or False in mask are masked out."""
+        x = self.gs_df.x.to_numpy(dtype=float)
+        y = self.gs_df.y.to_numpy(dtype=float)
+        
+        if spacing is None:
+            spacing = self.gs_df.attrs.get('grid_spacing')
+        if spacing is None:
+            steps = [np.diff(np.unique(coord)) for coord in (x, y)]
+            spacing = [step[step > self.epsilon].min() for step in steps]
+        self.grid_spacing = tuple(np.broadcast_to(np.asarray(spacing, dtype=float), 2))
+        
+        x_idx = np.rint(x / self.grid_spacing[0]).astype(np.int64)
+        y_idx = np.rint(y / self.grid_spacing[1]).astype(np.int64)
+        
+        if not (np.allclose(x_idx * self.grid_spacing[0], x, atol=self.epsilon)
+                and np.allclose(y_idx * self.grid_spacing[1], y, atol=self.epsilon)):
+            raise ValueError('Coordinates are not on a regular grid')
+        
+        vals = self.gs_df[self.val_col].to_numpy(dtype=float)
+        valid = ~np.isnan(vals)
+        if mask is not None:
+            valid &= np.asarray(mask, dtype=bool)
+        
+        grid = np.zeros((y_idx.max() + 1, x_idx.max() + 1))
+        grid_mask = np.zeros(grid.shape, dtype=bool)
+        grid[y_idx[valid], x_idx[valid]] = vals[valid]
+        grid_mask[y_idx[valid], x_idx[valid]] = True
+        return grid, grid_mask
+    
+    def fft_lag_sums(self, spacing=None, mask=None):
+        """Lag vectors with their pair counts and squared difference sums
+        from the FFT of the gridded values"""
+        grid, grid_mask = self.grid_values(spacing, mask)
+        counts, sums = fft_variogram_sums(grid, grid_mask)
+        
+        n_y, n_x = grid.shape
+        x_lags = np.arange(-(n_x - 1), n_x) * self.grid_spacing[0]
+        y_lags = np.arange(-(n_y - 1), n_y) * self.grid_spacing[1]
+        return x_lags, y_lags, counts, sums
+    
+    def calc_fft_variogram_map(self, spacing=None, mask=None):
+        """Variogram map of gridded values (e.g. FractureTrace windows) 
+        from FFTs in O(n log n), stored as variogram_map. Every lag vector
+        of the grid is a map cell."""
+        x_lags, y_lags, counts, sums = self.fft_lag_sums(spacing, mask)
+        
+        # each cell holds the pairs of one lag vector in one order
+        variogram_map = semivariance_frame(
+            counts.T.ravel(), sums.T.ravel(), orders=1
+            )
+        variogram_map.insert(0, 'x', np.repeat(x_lags, len(y_lags)))
+        variogram_map.insert(1, 'y', np.tile(y_lags, len(x_lags)))
+        self.variogram_map = variogram_map.dropna()
+    
+    def calc_fft_variograms(self, azimuths=None, spacing=None, mask=None):
+        """Omnidirectional (and optionally azimuthal) variograms of gridded
+        values by binning the FFT lag vectors with the same lag bins and
+        azimuth classes as the pair-based methods. Sets omni_variogram and,
+        if azimuths are given, azi_variogram. Missing values are masked
+        out rather than counted in n_pairs. Lag vectors on a bin edge
+        count in both bins like pairs, so the results equal the pair-based
+        ones when coordinate differences are exact (e.g. integer spacing);
+        otherwise a pair within rounding of a bin edge may fall in one bin
+        here and in both there, or the other way round."""
+        x_lags, y_lags, counts, sums = self.fft_lag_sums(spacing, mask)
+        
+        x_dist, y_dist = np.meshgrid(x_lags, y_lags)
+        lags = {
+            'x_dist': x_dist.ravel(), 'y_dist': y_dist.ravel(),
+            'xy_dist': np.hypot(x_dist, y_dist).ravel()
+            }
+        keep = (
+            (counts.ravel() > 0) & (lags['xy_dist'] <= self.max_dist)
+            & (lags['xy_dist'] > self.epsilon)
+            )
+        lags = {key: val[keep] for key, val in lags.items()}
+        counts = counts.ravel()[keep]
+        sums = sums.ravel()[keep]
+        
+        classes = [('omni', np.ones((1, len(counts)), dtype=bool))]
+        if azimuths is not None:
+            settings = self.azimuth_settings(azimuths)
+            classes.append(('azi', azimuth_classes(
+                lags, settings['azimuths_ccw_ew_rad'], 
+                settings['azi_tol_rad'], settings['bandwidth_tolerance']
+                )))
+        
+        for kind, members in classes:
+            extents = class_extents(lags, members, ['xy_dist'])
+            bins = self.bin_row_blocks(kind, extents, extents)
+            lag_counts = np.zeros(bins['n_bins'])
+            lag_sums = np.zeros(bins['n_bins'])
+            # lag vectors on a bin edge count in both bins
+            for shift in (-1, 0, 1):
+                idx = lag_class_index(lags, members, bins, shift)
+                keep = idx >= 0
+                lag_counts += np.bincount(
+                    idx[keep], np.broadcast_to(counts, members.shape).ravel()[keep],
+                    bins['n_bins']
+                    )
+                lag_sums += np.bincount(
+                    idx[keep], np.broadcast_to(sums, members.shape).ravel()[keep],
+                    bins['n_bins']
+                    )
+            
+            # the lag vectors hold each pair at +h and -h
+            variogram = semivariance_frame(lag_counts/2, lag_sums/2)
+            
+            if self.standardize_sill:
+                variogram['semivariance'] = (
+                    variogram['semivariance']/self.val_col_var
+                    )
+            
+            variogram['lag_bin'] = bins['lag_bins'].ravel()
+            
+            if kind == 'omni':
+                self.lag_bins = bins['lag_bins'][0]
+                self.lag_tolerance = bins['lag_tolerance'][0]
+                self.omni_variogram = variogram
+            else:
+                variogram['azimuth'] = np.repeat(azimuths, self.n_lags)
+                self.azi_variogram = variogram
+    
     def plot_variogram_map(self, lag_limit=None):
 
         x = self.variogram_map[['x']]
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, breadth_first_order
+from shapely.geometry import LineString
+
+def group_starts(groups):
+    """Start index and size of each run of equal values in sorted groups"""
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    return starts, np.diff(np.r_[starts, len(groups)])
+
+def pixel_keys(rows, cols, n_cols):
+    """Raster keys of pixels in an image padded by one pixel"""
+    return (np.asarray(rows, dtype=np.int64) + 1) * n_cols + cols + 1
+
+def find_pixels(sorted_keys, keys):
+    """Position of each key in sorted pixel keys, or -1 if it is absent"""
+    found = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[found] == keys, found, -1)
+
+def pixel_pairs(rows, cols):
+    """Index pairs of 8-connected pixels among the given pixels"""
+    if len(rows) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    n_cols = cols.max() + 3
+    keys = pixel_keys(rows, cols, n_cols)
+    order = np.argsort(keys)
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for d_row, d_col in [(0, 1), (1, -1), (1, 0), (1, 1)]:
+        found = find_pixels(keys[order], keys + d_row * n_cols + d_col)
+        hit = found >= 0
+        pairs.append(np.column_stack([np.flatnonzero(hit), order[found[hit]]]))
+    return np.concatenate(pairs)
+
+def component_lines(rows, cols, labels, min_length=0, tolerance=3.0,
+                    max_splits=16):
+    """Line segments ((x0, y0), (x1, y1)) fitted by PCA to the labelled 
+    pixels (rows, cols, labels), split up to max_splits times where pixels
+    lie further than tolerance from the line, keeping min_length and up"""
+    x, y = np.asarray(cols, dtype=float), np.asarray(rows, dtype=float)
+    pieces = np.asarray(labels, dtype=np.int64)
+    lines = [np.zeros((0, 2, 2))]
+    # fit all pieces at once from grouped moments, one level of splits at
+    # a time, so each level is a sort and a few reductions
+    for depth in range(max_splits + 1):
+        if len(pieces) == 0:
+            break
+        order = np.argsort(pieces, kind='stable')
+        x, y, pieces = x[order], y[order], pieces[order]
+        starts, counts = group_starts(pieces)
+        group = np.repeat(np.arange(len(starts)), counts)
+        
+        mean_x = np.add.reduceat(x, starts) / counts
+        mean_y = np.add.reduceat(y, starts) / counts
+        dx, dy = x - mean_x[group], y - mean_y[group]
+        theta = 0.5 * np.arctan2(
+            2 * np.add.reduceat(dx * dy, starts),
+            np.add.reduceat(dx * dx, starts) - np.add.reduceat(dy * dy, starts)
+            )
+        # segment along the principal axis between the extreme projections
+        ux, uy = np.cos(theta), np.sin(theta)
+        along = dx * ux[group] + dy * uy[group]
+        across = np.abs(dy * ux[group] - dx * uy[group])
+        t_min = np.minimum.reduceat(along, starts)
+        t_max = np.maximum.reduceat(along, starts)
+        max_across = np.maximum.reduceat(across, starts)
+        
+        # curved or branched pieces are split; short ones are dropped
+        length = t_max - t_min
+        split = ((max_across > tolerance) & (length >= min_length) 
+                 & (depth < max_splits))
+        fitted = ~split
+        ends = np.stack([
+            np.column_stack([mean_x + t_min * ux, mean_y + t_min * uy]),
+            np.column_stack([mean_x + t_max * ux, mean_y + t_max * uy])
+            ], axis=1)[fitted]
+        lines.append(ends[length[fitted] >= min_length])
+        
+        # split at the projection of the pixel furthest from the axis,
+        # or midway when that pixel is near an end
+        furthest = np.minimum.reduceat(
+            np.where(across == max_across[group], np.arange(len(x)), len(x)),
+            starts
+            )
+        t_split = along[furthest]
+        margin = 0.1 * length
+        t_split = np.where(
+            (t_split > t_min + margin) & (t_split < t_max - margin),
+            t_split, 0.5 * (t_min + t_max)
+            )
+        keep = split[group]
+        pieces = (2 * group + (along > t_split[group]))[keep]
+        x, y = x[keep], y[keep]
+        
+        # connected parts of the split pieces
+        pairs = pixel_pairs(y.astype(np.int64), x.astype(np.int64))
+        pairs = pairs[pieces[pairs[:,0]] == pieces[pairs[:,1]]]
+        graph = coo_matrix(
+            (np.ones(len(pairs)), (pairs[:,0], pairs[:,1])),
+            shape=(len(pieces), len(pieces))
+            )
+        pieces = connected_components(graph, directed=False)[1]
+    
+    lines = np.rint(np.concatenate(lines)).astype(int).tolist()
+    return [tuple(map(tuple, line)) for line in lines]
+
+def skeleton_polylines(rows, cols, min_length=0, tolerance=1.0):
+    """Polylines [(x, y), ...] between the junctions and ends of a one 
+    pixel wide skeleton (rows, cols), simplified to tolerance and kept 
+    from min_length up"""
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    n_pixels = len(rows)
+    if n_pixels == 0:
+        return []
+    # raster order, so the tracing does not depend on how pixels were read
+    n_cols = cols.max() + 3
+    keys = pixel_keys(rows, cols, n_cols)
+    raster = np.argsort(keys)
+    rows, cols, sorted_keys = rows[raster], cols[raster], keys[raster]
+    # drop diagonal links that cut the corner of an orthogonal step
+    pairs = pixel_pairs(rows, cols)
+    a, b = pairs[:,0], pairs[:,1]
+    corner = ((rows[a] != rows[b]) & (cols[a] != cols[b]) 
+              & ((find_pixels(sorted_keys, pixel_keys(rows[a], cols[b], n_cols)) >= 0)
+                 | (find_pixels(sorted_keys, pixel_keys(rows[b], cols[a], n_cols)) >= 0)))
+    pairs = pairs[~corner]
+    
+    # pixels with three or more links are junctions; the other links form
+    # simple paths or loops
+    junction = np.bincount(pairs.ravel(), minlength=n_pixels) >= 3
+    on_path = ~junction[pairs[:,0]] & ~junction[pairs[:,1]]
+    links, to_junction = pairs[on_path], pairs[~on_path]
+    n_paths, path = connected_components(coo_matrix(
+        (np.ones(len(links)), (links[:,0], links[:,1])), 
+        shape=(n_pixels, n_pixels)
+        ), directed=False)
+    
+    # start each path at an end, or open a loop at its first pixel
+    pixel = np.arange(n_pixels)
+    ends = pixel[~junction & (np.bincount(links.ravel(), minlength=n_pixels) <= 1)]
+    start = np.full(n_paths, n_pixels)
+    np.minimum.at(start, path[ends], ends)
+    loop = start == n_pixels
+    np.minimum.at(start, path[loop[path]], pixel[loop[path]])
+    loop &= ~junction[start]
+    loop_starts = start[loop]
+    from_start = np.isin(links[:,0], loop_starts)
+    at_start = np.flatnonzero(from_start | np.isin(links[:,1], loop_starts))
+    first_link = np.unique(
+        np.where(from_start[at_start], links[at_start,0], links[at_start,1]),
+        return_index=True
+        )[1]
+    links = np.delete(links, at_start[first_link], axis=0)
+    
+    # one breadth first search from the start of every path orders all
+    # paths in a single linear pass
+    start = start[~junction[start]]
+    search = np.concatenate([
+        links, np.column_stack([np.full(len(start), n_pixels), start])
+        ])
+    order = breadth_first_order(coo_matrix(
+        (np.ones(len(search)), (search[:,0], search[:,1])), 
+        shape=(n_pixels + 1, n_pixels + 1)
+        ).tocsr(), n_pixels, directed=False, return_predecessors=False)[1:]
+    order = order[np.argsort(path[order], kind='stable')]
+    
+    # junction pixels next to each path pixel, to join paths at junctions
+    to_junction = np.where(junction[to_junction[:,:1]], to_junction[:,::-1], to_junction)
+    to_junction = to_junction[~junction[to_junction[:,0]]]
+    first_junction, last_junction = np.full(n_pixels, n_pixels), np.full(n_pixels, -1)
+    np.minimum.at(first_junction, to_junction[:,0], to_junction[:,1])
+    np.maximum.at(last_junction, to_junction[:,0], to_junction[:,1])
+    
+    polylines = []
+    is_loop = np.zeros(n_paths, dtype=bool)
+    is_loop[path[loop_starts]] = True
+    starts, counts = group_starts(path[order])
+    for first, count in zip(starts, counts):
+        nodes = list(order[first:first + count])
+        if is_loop[path[nodes[0]]]:
+            nodes.append(nodes[0])
+        if first_junction[nodes[0]] < n_pixels:
+            nodes.insert(0, first_junction[nodes[0]])
+        if last_junction[nodes[-1]] >= 0:
+            nodes.append(last_junction[nodes[-1]])
+        if len(nodes) < 2:
+            continue
+        # Douglas-Peucker keeps pixel vertices
+        line = LineString(np.column_stack([cols[nodes], rows[nodes]]))
+        if line.length >= min_length:
+            polylines.append(
+                [(int(x), int(y)) for x, y in line.simplify(tolerance).coords]
+                )
+    return polylines
+
@@ -28,10 +28,10 @@ vgm.calc_omni_variogram()
 vgm.omni_variogram.plot('lag_bin','semivariance','scatter')
 vgm.write_omni_variogram()
 
-# get azimuth semivariogram for multiple azimuths
-for azimuth in [0, 30, 45, 60, 75, 90]:
-    vgm.azimuth_cw_from_ns_deg = azimuth
-    vgm.calc_azi_variogram()
+# get azimuth semivariogram for multiple azimuths in one pass
+azimuths = [0, 30, 45, 60, 75, 90]
+vgm.calc_azi_variograms(azimuths)
+for azimuth in azimuths:
     vgm.azi_variogram[
         vgm.azi_variogram.azimuth == azimuth
         ].plot('lag_bin','semivariance','scatter')